@@ -0,0 +1,5 @@
+@rem Copyright (c) 2014 Turbulenz Limited
+@echo off
+@rem Benchmark the local development server leaderboards.
+
+@python -m turbulenz_local.benchmarkleaderboards %*
@@ -0,0 +1,5 @@
+@rem Copyright (c) 2014 Turbulenz Limited
+@echo off
+@rem Convert the local development server leaderboards to the binary format.
+
+@python -m turbulenz_local.convertleaderboards %*
@@ -0,0 +1,5 @@
+@rem Copyright (c) 2014 Turbulenz Limited
+@echo off
+@rem Convert the local development server userdata to the packed format.
+
+@python -m turbulenz_local.convertuserdata %*
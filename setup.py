@@ -40,7 +40,8 @@ setup(name='turbulenz_local',
     packages=[ 'turbulenz_local',
                'turbulenz_local.controllers', 'turbulenz_local.controllers.apiv1',
                'turbulenz_local.controllers.localv1',
-               'turbulenz_local.handlers', 'turbulenz_local.handlers.localv1',
+               'turbulenz_local.handlers', 'turbulenz_local.handlers.apiv1',
+               'turbulenz_local.handlers.localv1',
                'turbulenz_local.lib', 'turbulenz_local.middleware',
                'turbulenz_local.models', 'turbulenz_local.models.apiv1' ],
     include_package_data=True,
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# Copyright (c) 2014 Turbulenz Limited
+
+import argparse
+import sys
+from os import makedirs
+from os.path import join, exists
+from random import Random
+from shutil import rmtree
+from tempfile import mkdtemp
+from timeit import default_timer
+
+# pylint: disable=F0401
+import yaml
+from pylons import config
+from simplejson import load as json_load, dump as json_dump
+# pylint: enable=F0401
+
+from turbulenz_local.models.user import User
+from turbulenz_local.models.userlist import get_user_summary
+from turbulenz_local.models.apiv1.leaderboards import GameLeaderboards, UserScore, LEADERBOARD_FORMATS, \
+                                                      write_binary_scores
+
+BENCHMARK_KEY = 'scores'
+BENCHMARK_OPERATIONS = ['get_top_players', 'get_page', 'get_near', 'read_overview', 'set']
+DEFAULT_SIZES = '1000,100000,1000000'
+MAX_SCORE = 1000000.0
+
+
+def echo(msg):
+    print msg
+
+def error(msg):
+    echo('ERROR: %s' % msg)
+
+
+class BenchmarkGame(object):
+    """ The parts of a Game used by GameLeaderboards """
+
+    def __init__(self, slug, path):
+        self.slug = slug
+        self.path = path
+
+
+def get_username(index):
+    return 'bench%d' % index
+
+
+def seed_leaderboard(game, leaderboards_db, leaderboard_format, size, rng):
+    f = open(join(game.path, 'leaderboards.yaml'), 'w')
+    try:
+        yaml.dump([{'key': BENCHMARK_KEY, 'title': 'Benchmark', 'sortBy': 1}], f, default_flow_style=False)
+    finally:
+        f.close()
+
+    path = join(leaderboards_db, game.slug)
+    makedirs(path)
+
+    score_time = 1400000000.0
+    user_scores = [UserScore(get_username(i), rng.random() * MAX_SCORE, score_time + i) for i in xrange(size)]
+    if leaderboard_format == 'binary':
+        # binary files are written best score first by the server and are loaded without sorting
+        user_scores.sort(key=lambda s: (-s.score, s.score_time))
+        f = open(join(path, BENCHMARK_KEY + '.bin'), 'wb')
+        try:
+            write_binary_scores(f, user_scores)
+        finally:
+            f.close()
+    else:
+        f = open(join(path, BENCHMARK_KEY + '.yaml'), 'w')
+        try:
+            yaml.dump([s.to_dict() for s in user_scores], f, default_flow_style=False)
+        finally:
+            f.close()
+
+
+def prime_user_summaries(user_yaml, size):
+    # a running server would already have the players on its leaderboards in its user list so write them to the
+    # user file up front rather than measuring the user file being rewritten for every new username
+    f = open(user_yaml, 'w')
+    try:
+        yaml.dump({'users': [get_username(i) for i in xrange(size)]}, f, default_flow_style=False)
+    finally:
+        f.close()
+
+    for i in xrange(size):
+        get_user_summary(get_username(i))
+
+
+def get_percentile(sorted_latencies, percentile):
+    return sorted_latencies[int(round(percentile * (len(sorted_latencies) - 1)))]
+
+
+def measure(operation, args_list):
+    latencies = []
+    start = default_timer()
+    for args in args_list:
+        op_start = default_timer()
+        operation(*args)
+        latencies.append(default_timer() - op_start)
+    total = default_timer() - start
+
+    latencies.sort()
+    return {
+        'throughput': len(latencies) / total,
+        'p50': get_percentile(latencies, 0.5) * 1000.0,
+        'p99': get_percentile(latencies, 0.99) * 1000.0
+    }
+
+
+def benchmark_leaderboard(game, size, num_operations, rng):
+    leaderboards = GameLeaderboards(game)
+
+    # load the leaderboard before timing the queries
+    start = default_timer()
+    leaderboards.get_top_players(BENCHMARK_KEY, User(get_username(0)), 1)
+    load_time = (default_timer() - start) * 1000.0
+
+    # create the arguments up front so that only the leaderboard calls are timed
+    def random_users():
+        return [User(get_username(rng.randrange(size))) for _ in xrange(num_operations)]
+
+    results = {}
+    results['get_top_players'] = measure(leaderboards.get_top_players,
+                                         [(BENCHMARK_KEY, user, 9) for user in random_users()])
+    results['get_page'] = measure(leaderboards.get_page,
+                                  [(BENCHMARK_KEY, user, 16, rng.random() < 0.5, rng.random() * MAX_SCORE, 0)
+                                   for user in random_users()])
+    results['get_near'] = measure(leaderboards.get_near,
+                                  [(BENCHMARK_KEY, user, 9) for user in random_users()])
+    results['read_overview'] = measure(leaderboards.read_overview,
+                                       [(user, ) for user in random_users()])
+    # set last as it changes the leaderboard, about half of the new scores beat the users previous score
+    results['set'] = measure(leaderboards.set,
+                             [(BENCHMARK_KEY, user, rng.random() * MAX_SCORE) for user in random_users()])
+
+    return load_time, results
+
+
+def run_benchmarks(data_path, leaderboard_format, sizes, num_operations, seed):
+    leaderboards_db = join(data_path, 'leaderboards')
+    config['leaderboards_db'] = leaderboards_db
+    config['leaderboards.format'] = leaderboard_format
+    config['user.yaml'] = join(data_path, 'user.yaml')
+
+    rng = Random(seed)
+    prime_user_summaries(config['user.yaml'], max(sizes))
+
+    results = {}
+    for size in sizes:
+        game = BenchmarkGame('benchmark-%d' % size, join(data_path, 'games', 'benchmark-%d' % size))
+        makedirs(game.path)
+
+        echo('Seeding %d scores...' % size)
+        seed_leaderboard(game, leaderboards_db, leaderboard_format, size, rng)
+
+        (load_time, size_results) = benchmark_leaderboard(game, size, num_operations, rng)
+        echo('Loaded %d scores in %.1fms' % (size, load_time))
+        echo('%-16s %14s %10s %10s' % ('operation', 'ops/s', 'p50 ms', 'p99 ms'))
+        for operation in BENCHMARK_OPERATIONS:
+            r = size_results[operation]
+            echo('%-16s %14.1f %10.3f %10.3f' % (operation, r['throughput'], r['p50'], r['p99']))
+        echo('')
+
+        size_results['load'] = {'time': load_time}
+        results[str(size)] = size_results
+
+    return {
+        'format': leaderboard_format,
+        'operations': num_operations,
+        'seed': seed,
+        'results': results
+    }
+
+
+def compare_baseline(baseline, results, tolerance):
+    regressed = False
+    if baseline.get('format') != results['format']:
+        echo('WARNING: Comparing %s leaderboards with a %s baseline' % (results['format'], baseline.get('format')))
+
+    for (size, size_results) in sorted(results['results'].iteritems(), key=lambda r: int(r[0])):
+        try:
+            baseline_results = baseline['results'][size]
+        except KeyError:
+            echo('No baseline for %s scores' % size)
+            continue
+
+        for operation in BENCHMARK_OPERATIONS:
+            try:
+                baseline_p99 = baseline_results[operation]['p99']
+            except KeyError:
+                continue
+            p99 = size_results[operation]['p99']
+            if p99 > baseline_p99 * tolerance:
+                error('%s on %s scores regressed: p99 %.3fms, baseline %.3fms' % (operation, size, p99, baseline_p99))
+                regressed = True
+
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the local development server leaderboards on "
+                                                 "synthetic leaderboards and reports the throughput and the p50 and "
+                                                 "p99 latencies of each operation.")
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help="Comma separated number of scores on each leaderboard (default %s)" % DEFAULT_SIZES)
+    parser.add_argument('--operations', type=int, default=1000,
+                        help="The number of times each operation is run on each leaderboard (default 1000)")
+    parser.add_argument('--format', choices=LEADERBOARD_FORMATS, default='binary',
+                        help="The leaderboards.format to benchmark (default binary)")
+    parser.add_argument('--seed', type=int, default=0, help="The random seed (default 0)")
+    parser.add_argument('--data', help="Seed the leaderboards in this folder and keep them after the benchmark "
+                                       "instead of using a temporary folder")
+    parser.add_argument('--baseline', help="Write the results to this JSON file")
+    parser.add_argument('--compare', help="Fail if any p99 latency is worse than the results in this JSON file")
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help="The factor a p99 latency can exceed the --compare results by (default 1.5)")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    try:
+        sizes = [int(s) for s in args.sizes.split(',')]
+        if min(sizes) <= 0:
+            raise ValueError()
+    except ValueError:
+        error('--sizes must be a comma separated list of positive integers')
+        exit(1)
+
+    if args.operations <= 0:
+        error('--operations must be a positive integer')
+        exit(1)
+
+    baseline = None
+    if args.compare:
+        try:
+            f = open(args.compare, 'r')
+            try:
+                baseline = json_load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError) as e:
+            error('Failed loading "%s": %s' % (args.compare, str(e)))
+            exit(1)
+
+    if args.data:
+        if exists(args.data):
+            error('Data folder "%s" already exists' % args.data)
+            exit(1)
+        data_path = args.data
+        makedirs(data_path)
+    else:
+        data_path = mkdtemp(prefix='benchmarkleaderboards')
+
+    try:
+        results = run_benchmarks(data_path, args.format, sizes, args.operations, args.seed)
+    finally:
+        if not args.data:
+            rmtree(data_path, ignore_errors=True)
+
+    if args.baseline:
+        try:
+            f = open(args.baseline, 'w')
+            try:
+                json_dump(results, f, indent=4, sort_keys=True)
+            finally:
+                f.close()
+        except IOError as e:
+            error('Failed writing "%s": %s' % (args.baseline, str(e)))
+            exit(1)
+        echo('Written baseline "%s"' % args.baseline)
+
+    if baseline is not None and compare_baseline(baseline, results, args.tolerance):
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
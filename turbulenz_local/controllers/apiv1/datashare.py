@@ -25,6 +25,8 @@ class DatashareController(BaseController):
     datashare_service = ServiceStatus.check_status_decorator('datashare')
     game_session_list = GameSessionList.get_instance()
 
+    max_batch_size = 64
+
     # Testing only - Not available on the Gamesite
     @classmethod
     @postonly
@@ -106,6 +108,26 @@ class DatashareController(BaseController):
         datashare_key = datashare.get(session.user, key)
         return {'ok': True, 'data': datashare_key}
 
+    @classmethod
+    @datashare_service
+    @secure_get
+    def read_batch(cls, datashare_id, params=None):
+        session = cls._get_gamesession(params)
+        datashare = DataShareList.get(session.game).get(datashare_id)
+
+        try:
+            keys = params['keys']
+        except KeyError:
+            raise BadRequest('Keys missing')
+        # unencrypted requests can give the keys as a comma separated string
+        if isinstance(keys, basestring):
+            keys = keys.split(',')
+        if not isinstance(keys, list) or len(keys) > cls.max_batch_size:
+            raise BadRequest('Keys must be an array of at most %d keys' % cls.max_batch_size)
+
+        # keys that do not exist are left out of the values
+        return {'ok': True, 'data': {'values': datashare.get_many(session.user, keys)}}
+
     @classmethod
     @datashare_service
     @secure_post
@@ -1,14 +1,20 @@
 # Copyright (c) 2011-2013 Turbulenz Limited
 
 from math import isinf, isnan
+from hashlib import sha1
+
+from simplejson import JSONEncoder
 
 # pylint: disable=F0401
-from pylons import request, response
+from pylons import request, response, config
+from pylons.controllers.util import abort
 # pylint: enable=F0401
 
 from turbulenz_local.lib.validation import ValidationException
 from turbulenz_local.lib.exceptions import BadRequest
 from turbulenz_local.lib.servicestatus import ServiceStatus
+from turbulenz_local.lib.lrucache import LRUCache
+from turbulenz_local.lib.tools import create_id
 from turbulenz_local.decorators import secure_post, jsonify, postonly
 
 from turbulenz_local.controllers import BaseController
@@ -17,6 +23,10 @@ from turbulenz_local.models.gamelist import get_game_by_slug
 from turbulenz_local.models.apiv1.leaderboards import LeaderboardsList, LeaderboardError
 from turbulenz_local.models.userlist import get_current_user
 
+# pylint: disable=C0103
+_json_encoder = JSONEncoder(encoding='utf-8', separators=(',',':'))
+# pylint: enable=C0103
+
 
 class LeaderboardsController(BaseController):
     """ LeaderboardsController consists of all the Leaderboards methods
@@ -27,6 +37,12 @@ class LeaderboardsController(BaseController):
     max_top_size = 32
     max_near_size = 32
     max_page_size = 64
+    max_batch_size = 32
+
+    # encoded read_expanded responses keyed by the query and the version of the leaderboard
+    response_cache = LRUCache(int(config.get('leaderboards.response_cache_size', 1024)))
+    # leaderboard versions restart with the server so the etags are made unique to this process
+    etag_prefix = create_id()[:8]
 
     @classmethod
     @leaderboards_service
@@ -124,6 +140,7 @@ class LeaderboardsController(BaseController):
 
         try:
             leaderboards = LeaderboardsList.get(game)
+            user = get_current_user()
 
             is_above = (method_type == 'above')
             if method_type == 'below' or is_above:
@@ -137,20 +154,32 @@ class LeaderboardsController(BaseController):
                     response.status_int = 400
                     return {'ok': False, 'msg': 'Score or time parameter missing'}
 
-                return {'ok': True, 'data': leaderboards.get_page(key,
-                                                                  get_current_user(),
-                                                                  get_size(5, cls.max_page_size),
-                                                                  is_above,
-                                                                  score,
-                                                                  score_time)}
-            if method_type == 'near':
-                return {'ok': True, 'data': leaderboards.get_near(key,
-                                                                  get_current_user(),
-                                                                  get_size(9, cls.max_near_size))}
+                size = get_size(5, cls.max_page_size)
+                query = (method_type, size, score, score_time)
+                get_data = lambda: leaderboards.get_page(key, user, size, is_above, score, score_time)
+            elif method_type == 'near':
+                size = get_size(9, cls.max_near_size)
+                query = (method_type, size)
+                get_data = lambda: leaderboards.get_near(key, user, size)
             else:  # method_type == 'top'
-                return {'ok': True, 'data': leaderboards.get_top_players(key,
-                                                                         get_current_user(),
-                                                                         get_size(9, cls.max_top_size))}
+                size = get_size(9, cls.max_top_size)
+                query = ('top', size)
+                get_data = lambda: leaderboards.get_top_players(key, user, size)
+
+            # the player row depends on the user and jsonp responses are wrapped by the callback
+            cache_key = (slug, key, query, user.username, params.get('callback'),
+                         leaderboards.get_version(key))
+            etag = '"%s-%x-%s"' % (cls.etag_prefix, cache_key[-1], sha1(repr(cache_key[:-1])).hexdigest()[:16])
+            # the etag only depends on the query and version so the client's copy is checked before running the query
+            if request.headers.get('If-None-Match') == etag:
+                abort(304, headers=[('Etag', etag)])
+            response.headers['Etag'] = etag
+
+            body = cls.response_cache.get(cache_key)
+            if body is None:
+                body = _json_encoder.encode({'ok': True, 'data': get_data()})
+                cls.response_cache.set(cache_key, body)
+            return body
 
         except ValidationException as e:
             response.status_int = 400
@@ -190,6 +219,55 @@ class LeaderboardsController(BaseController):
             return {'ok': False, 'msg': str(e)}
 
 
+    @classmethod
+    @leaderboards_service
+    @secure_post
+    def set_batch(cls, params=None):
+        session = cls._get_gamesession(params)
+
+        try:
+            batch = params['batch']
+        except KeyError:
+            raise BadRequest('Score batch missing')
+
+        if not isinstance(batch, list) or len(batch) > cls.max_batch_size:
+            raise BadRequest('Score batch must be an array of at most %d scores' % cls.max_batch_size)
+
+        # check every entry before any scores are set so that a bad entry leaves all of the leaderboards unchanged
+        try:
+            key_scores = []
+            for s in batch:
+                key = s['key']
+                if not isinstance(key, basestring):
+                    raise TypeError()
+                score = s['score']
+                if isinstance(score, bool):
+                    raise TypeError()
+                score = float(score)
+                if isinf(score) or isnan(score):
+                    response.status_int = 400
+                    return {'ok': False, 'msg': '"score" for key "%s" must be a finite number' % key}
+                if score < 0:
+                    response.status_int = 400
+                    return {'ok': False, 'msg': '"score" for key "%s" cannot be a negative number' % key}
+                key_scores.append((key, score))
+
+        except (TypeError, ValueError, KeyError):
+            response.status_int = 400
+            return {'ok': False, 'msg': 'Key or score is missing or incorrectly formated'}
+
+        try:
+            leaderboards = LeaderboardsList.get(session.game)
+            return {'ok': True, 'data': leaderboards.set_batch(session.user, key_scores)}
+
+        except ValidationException as e:
+            response.status_int = 400
+            return {'ok': False, 'msg': str(e)}
+        except LeaderboardError as e:
+            response.status_int = e.response_code
+            return {'ok': False, 'msg': str(e)}
+
+
     @classmethod
     @leaderboards_service
     @jsonify
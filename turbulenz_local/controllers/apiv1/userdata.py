@@ -8,6 +8,7 @@ from pylons import response
 
 from turbulenz_local.decorators import secure_get, secure_post
 from turbulenz_local.lib.servicestatus import ServiceStatus
+from turbulenz_local.lib.exceptions import BadRequest
 
 from turbulenz_local.controllers import BaseController
 
@@ -24,6 +25,24 @@ def _set_json_headers(headers):
 class UserDataGameNotFound(Exception):
     pass
 
+def _get_batch_keys(params, max_batch_size):
+    try:
+        keys = params['keys']
+    except KeyError:
+        raise BadRequest('Keys missing')
+
+    # unencrypted requests can give the keys as a comma separated string
+    if isinstance(keys, basestring):
+        keys = keys.split(',')
+
+    if not isinstance(keys, list) or len(keys) > max_batch_size:
+        raise BadRequest('Keys must be an array of at most %d keys' % max_batch_size)
+
+    for key in keys:
+        if not isinstance(key, basestring) or not UserData.validate_key.match(key):
+            raise BadRequest('Invalid key "%s"' % key)
+    return keys
+
 class UserdataController(BaseController):
     """ UserdataController consists of all the Userdata methods
     """
@@ -32,6 +51,8 @@ class UserdataController(BaseController):
 
     userdata_service = ServiceStatus.check_status_decorator('userdata')
 
+    max_batch_size = 64
+
     @classmethod
     @userdata_service
     @secure_get
@@ -65,6 +86,18 @@ class UserdataController(BaseController):
         else:
             return {'ok': True,  'value': value}
 
+    @classmethod
+    @userdata_service
+    @secure_get
+    def read_batch(cls, params=None):
+        _set_json_headers(response.headers)
+        userdata = UserData(cls._get_gamesession(params))
+
+        keys = _get_batch_keys(params, cls.max_batch_size)
+
+        # keys that do not exist are left out of the values
+        return {'ok': True, 'values': userdata.get_many(keys)}
+
     @classmethod
     @userdata_service
     @secure_post
@@ -76,6 +109,30 @@ class UserdataController(BaseController):
         userdata.set(key, value)
         return {'ok': True}
 
+    @classmethod
+    @userdata_service
+    @secure_post
+    def set_batch(cls, params=None):
+        userdata = UserData(cls._get_gamesession(params))
+
+        try:
+            values = params['values']
+        except KeyError:
+            raise BadRequest('Values missing')
+
+        if not isinstance(values, dict) or len(values) > cls.max_batch_size:
+            raise BadRequest('Values must be an object of at most %d keys' % cls.max_batch_size)
+
+        for (key, value) in values.iteritems():
+            if not UserData.validate_key.match(key):
+                raise BadRequest('Invalid key "%s"' % key)
+            if not isinstance(value, basestring):
+                raise BadRequest('Value for key "%s" must be a string' % key)
+
+        # either all of the values are set or none of them are
+        userdata.set_many(values)
+        return {'ok': True}
+
     @classmethod
     @userdata_service
     @secure_post
@@ -90,6 +147,23 @@ class UserdataController(BaseController):
         else:
             return {'ok': True}
 
+    @classmethod
+    @userdata_service
+    @secure_post
+    def remove_batch(cls, params=None):
+        userdata = UserData(cls._get_gamesession(params))
+
+        keys = _get_batch_keys(params, cls.max_batch_size)
+
+        # none of the keys are removed if any of them do not exist
+        try:
+            userdata.remove_many(keys)
+        except UserDataKeyError:
+            response.status_int = 404
+            return {'ok': False, 'msg': 'Key does not exist'}
+        else:
+            return {'ok': True}
+
     @classmethod
     @userdata_service
     @secure_post
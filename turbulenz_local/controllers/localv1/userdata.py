@@ -5,17 +5,15 @@ from os import listdir
 from os.path import join, exists
 
 # pylint: disable=F0401
-from pylons import response, config
-from pylons.controllers.util import forward, abort
-
-from paste.fileapp import FileApp
+from pylons import request, response, config
+from pylons.controllers.util import abort
 # pylint: enable=F0401
 
+from turbulenz_local.tools import accepts_gzip
 from turbulenz_local.decorators import jsonify
 from turbulenz_local.controllers import BaseController
 from turbulenz_local.models.userlist import get_user
-from turbulenz_local.models.game import _File
-from turbulenz_local.models.apiv1.userdata import UserData
+from turbulenz_local.models.apiv1.userdata import UserData, UserDataKeyError, is_compressed, decompress_value
 from turbulenz_local.models.gamelist import get_game_by_slug
 
 LOG = logging.getLogger(__name__)
@@ -66,16 +64,16 @@ class UserdataController(BaseController):
         if userdata is None:
             response.status_int = 400
             return {'ok': False, 'msg': 'No session with that ID exists'}
-        data_list = userdata.get_keys()
+        # everything listed comes from the key index so none of the values are read
+        key_info = userdata.get_key_info()
 
         userdata = { }
-        for i in data_list:
-            file_path = join(cls.datapath, slug, username, i) + '.txt'
-            f = _File(i, file_path, username, file_path)
-            userdata[f.name] = {
-                'assetName': f.name,
-                'isJson': f.is_json(),
-                'size': f.get_size()
+        for (key, info) in key_info.iteritems():
+            userdata[key] = {
+                'assetName': key,
+                'isJson': info['json'],
+                'size': info['size'],
+                'modified': info['modified']
             }
 
         return {
@@ -83,14 +81,34 @@ class UserdataController(BaseController):
             'data': userdata
         }
 
+    @classmethod
+    @jsonify
+    def cache_stats(cls):
+        return {
+            'ok': True,
+            'data': UserData.get_cache_stats()
+        }
+
     @classmethod
     def as_text(cls, slug, username, key):
-        filepath = join(cls.datapath, slug, username, '%s.txt' % key)
-        headers = [('Content-Type', 'text/plain'), ('Content-Disposition', 'attachment; filename=%s' % key) ]
+        game = get_game_by_slug(slug)
+        if not game or not exists(join(cls.datapath, slug, username)):
+            abort(404, 'Game does not exist: %s' % slug)
 
+        # the value is read through UserData as packed userdata is not stored in a file per key
         try:
-            text = forward(FileApp(filepath, headers))
-        except OSError:
-            abort(404, 'Game does not exist: %s' % slug)
-        else:
-            return text
+            text = UserData(user=get_user(username), game=game).get_stored(key)
+        except UserDataKeyError:
+            abort(404, 'Key does not exist: %s' % key)
+
+        # compressed values are sent as they are stored to clients that accept gzip
+        if is_compressed(text):
+            response.headers['Vary'] = 'Accept-Encoding'
+            if accepts_gzip(request.environ):
+                response.headers['Content-Encoding'] = 'gzip'
+            else:
+                text = decompress_value(text)
+
+        response.headers['Content-Type'] = 'text/plain'
+        response.headers['Content-Disposition'] = 'attachment; filename=%s' % str(key)
+        return text
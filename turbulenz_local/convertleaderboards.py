@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# Copyright (c) 2014 Turbulenz Limited
+
+import argparse
+import sys
+from os import listdir, remove
+from os.path import join, isdir, splitext
+
+# pylint: disable=F0401
+import yaml
+# pylint: enable=F0401
+
+from turbulenz_local.tools import replace_file
+from turbulenz_local.models.apiv1.leaderboards import UserScore, write_binary_scores
+
+
+def echo(msg):
+    print msg
+
+def error(msg):
+    echo('ERROR: %s' % msg)
+
+
+def convert_leaderboard(yaml_path, binary_path):
+    f = open(yaml_path, 'r')
+    try:
+        file_leaderboard = yaml.load(f)
+    finally:
+        f.close()
+
+    user_scores = [UserScore(s['user'], float(s['score']), float(s['time'])) for s in file_leaderboard or []]
+
+    tmp_path = binary_path + '.tmp'
+    f = open(tmp_path, 'wb')
+    try:
+        write_binary_scores(f, user_scores)
+    finally:
+        f.close()
+    replace_file(tmp_path, binary_path)
+
+    return len(user_scores)
+
+
+def convert_leaderboards(leaderboards_db, remove_yaml=False):
+    failed = False
+    for slug in sorted(listdir(leaderboards_db)):
+        game_path = join(leaderboards_db, slug)
+        if not isdir(game_path):
+            continue
+
+        for filename in sorted(listdir(game_path)):
+            (key, ext) = splitext(filename)
+            if ext != '.yaml':
+                continue
+
+            yaml_path = join(game_path, filename)
+            try:
+                num_scores = convert_leaderboard(yaml_path, join(game_path, key + '.bin'))
+                if remove_yaml:
+                    remove(yaml_path)
+            except (IOError, OSError, KeyError, TypeError, ValueError, yaml.YAMLError) as e:
+                error('Failed converting "%s": %s' % (yaml_path, str(e)))
+                failed = True
+            else:
+                echo('Converted: %s/%s (%d scores)' % (slug, key, num_scores))
+
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Converts the local development server leaderboards from YAML "
+                                                 "to the binary format used when leaderboards.format = binary. "
+                                                 "The local development server must not be running.")
+    parser.add_argument('leaderboards_db', help="The leaderboards folder, e.g. devserver/localdata/leaderboards")
+    parser.add_argument('--remove', action='store_true', help="Remove the YAML files once they are converted")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    if not isdir(args.leaderboards_db):
+        error('Leaderboards folder "%s" does not exist' % args.leaderboards_db)
+        return 1
+
+    if convert_leaderboards(args.leaderboards_db, args.remove):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# Copyright (c) 2014 Turbulenz Limited
+
+import argparse
+import sys
+from os import listdir
+from os.path import join, isdir, exists
+
+from turbulenz_local.tools import replace_file
+from turbulenz_local.models.apiv1.userdata import PACK_FILENAME, read_userdata_files, write_userdata_pack, \
+                                                  remove_userdata_files
+
+
+def echo(msg):
+    print msg
+
+def error(msg):
+    echo('ERROR: %s' % msg)
+
+
+def convert_user(user_path):
+    items = read_userdata_files(user_path)
+
+    pack_path = join(user_path, PACK_FILENAME)
+    tmp_path = pack_path + '.tmp'
+    f = open(tmp_path, 'wb')
+    try:
+        write_userdata_pack(f, items)
+    finally:
+        f.close()
+    replace_file(tmp_path, pack_path)
+
+    return len(items)
+
+
+def convert_userdata(userdata_db, remove_files=False):
+    failed = False
+    for slug in sorted(listdir(userdata_db)):
+        game_path = join(userdata_db, slug)
+        if not isdir(game_path):
+            continue
+
+        for username in sorted(listdir(game_path)):
+            user_path = join(game_path, username)
+            if not isdir(user_path):
+                continue
+
+            if exists(join(user_path, PACK_FILENAME)):
+                echo('Skipped: %s/%s (already packed)' % (slug, username))
+                continue
+
+            try:
+                num_keys = convert_user(user_path)
+                if remove_files:
+                    remove_userdata_files(user_path)
+            except (IOError, OSError) as e:
+                error('Failed converting "%s": %s' % (user_path, str(e)))
+                failed = True
+            else:
+                echo('Converted: %s/%s (%d keys)' % (slug, username, num_keys))
+
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Converts the local development server userdata from one file per "
+                                                 "key to the pack files used when userdata.format = packed. "
+                                                 "The local development server must not be running.")
+    parser.add_argument('userdata_db', help="The userdata folder, e.g. devserver/localdata/userdata")
+    parser.add_argument('--remove', action='store_true', help="Remove the key files once they are converted")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    if not isdir(args.userdata_db):
+        error('Userdata folder "%s" does not exist' % args.userdata_db)
+        return 1
+
+    if convert_userdata(args.userdata_db, args.remove):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
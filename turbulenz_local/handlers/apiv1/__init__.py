@@ -0,0 +1,2 @@
+# Copyright (c) 2014 Turbulenz Limited
+
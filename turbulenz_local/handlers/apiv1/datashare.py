@@ -0,0 +1,145 @@
+# Copyright (c) 2014 Turbulenz Limited
+from logging import getLogger
+from time import time
+
+# pylint: disable=F0401
+from tornado.web import RequestHandler, asynchronous
+from tornado.ioloop import IOLoop
+from pylons import config
+from paste.deploy.converters import asint
+from simplejson import JSONEncoder, JSONDecoder
+# pylint: enable=F0401
+
+from turbulenz_local.lib.servicestatus import ServiceStatus
+from turbulenz_local.lib.exceptions import ApiException, ApiUnavailable, BadRequest, InvalidGameSession
+from turbulenz_local.models.gamesessionlist import GameSessionList
+from turbulenz_local.models.apiv1.datashare import DataShareList
+
+LOG = getLogger(__name__)
+
+# pylint: disable=C0103
+_json_encoder = JSONEncoder(encoding='utf-8', separators=(',',':'))
+_json_decoder = JSONDecoder(encoding='utf-8')
+# pylint: enable=C0103
+
+# pylint: disable=R0904,W0221,E1103
+class DataShareWatchHandler(RequestHandler):
+    """
+    Long polls for changes to datashare keys. The request waits on the IO loop
+    until one of the keys is changed from the token the client last read for
+    it or the timeout expires, so clients can wait for other players without
+    repeatedly reading the keys.
+    """
+
+    def initialize(self):
+        self.datashare = None
+        self.timeout = None
+        self.done = False
+
+    def set_default_headers(self):
+        self.set_header('Server', 'tz')
+        self.set_header('Cache-Control', 'private, max-age=0')
+
+    def _get_params(self):
+        # the same parameters as the secure datashare APIs, either JSON encoded in data or as query arguments
+        data = self.get_argument('data', None)
+        if data is not None:
+            try:
+                params = _json_decoder.decode(data)
+            except ValueError:
+                raise BadRequest('Data must be JSON encoded')
+            if not isinstance(params, dict):
+                raise BadRequest('Data must be a JSON object')
+            return params
+
+        params = dict((name, self.get_argument(name)) for name in self.request.arguments.iterkeys())
+        keys = params.get('keys')
+        if isinstance(keys, basestring):
+            try:
+                params['keys'] = _json_decoder.decode(keys)
+            except ValueError:
+                raise BadRequest('Keys must be a JSON object of keys and the last tokens read for them')
+        return params
+
+    def _get_timeout(self, params):
+        max_timeout = asint(config.get('datashare.watch_timeout', 30))
+        try:
+            timeout = float(params.get('timeout', max_timeout))
+        except (TypeError, ValueError):
+            raise BadRequest('Timeout must be a number of seconds')
+        return min(max(timeout, 0), max_timeout)
+
+    def _finish_json(self, data, status=200):
+        # the same reply as the datashare controller's secure APIs
+        data['requestUrl'] = self.request.path
+        self.done = True
+        self.set_status(status)
+        self.set_header('Content-Type', 'application/json; charset=utf-8')
+        self.finish(_json_encoder.encode(data))
+
+    def _finish_changes(self, changes):
+        if self.done:
+            return
+        if self.timeout is not None:
+            IOLoop.instance().remove_timeout(self.timeout)
+            self.timeout = None
+
+        if changes is None:
+            self._finish_json({'ok': False, 'msg': 'No data share with id "%s"' % self.datashare.datashare_id},
+                              404)
+        else:
+            self._finish_json({'ok': True, 'data': {'keys': changes}})
+
+    def _on_change(self, changes):
+        # called by the datashare while it is locked and possibly from another thread
+        IOLoop.instance().add_callback(self._finish_changes, changes)
+
+    def _on_timeout(self):
+        self.timeout = None
+        if self.done:
+            return
+        self.datashare.unwatch(self._on_change)
+        self._finish_json({'ok': True, 'data': {'keys': []}})
+
+    @asynchronous
+    def get(self, datashare_id):
+        try:
+            service_status = ServiceStatus.get_status('datashare')
+            if not service_status['running']:
+                raise ApiUnavailable(service_status)
+
+            params = self._get_params()
+            try:
+                session = GameSessionList.get_instance().get_session(params['gameSessionId'])
+            except KeyError:
+                raise BadRequest('Request is missing gameSessionId parameter')
+            if session is None:
+                raise InvalidGameSession('No gamesession with that id')
+
+            timeout = self._get_timeout(params)
+            datashare = DataShareList.get(session.game).get(datashare_id)
+            changes = datashare.watch(session.user, params.get('keys'), self._on_change)
+
+        except ApiUnavailable as e:
+            return self._finish_json({'ok': False, 'msg': 'Service Unavailable', 'data': e.value}, 503)
+        except ApiException as e:
+            data = {'ok': False, 'msg': e.value}
+            if e.json_data:
+                data['data'] = e.json_data
+            return self._finish_json(data, int(e.status.split(' ', 1)[0]))
+
+        if changes or timeout == 0:
+            if not changes:
+                datashare.unwatch(self._on_change)
+            return self._finish_json({'ok': True, 'data': {'keys': changes}})
+
+        self.datashare = datashare
+        self.timeout = IOLoop.instance().add_timeout(time() + timeout, self._on_timeout)
+
+    def on_connection_close(self):
+        self.done = True
+        if self.timeout is not None:
+            IOLoop.instance().remove_timeout(self.timeout)
+            self.timeout = None
+        if self.datashare is not None:
+            self.datashare.unwatch(self._on_change)
@@ -0,0 +1,111 @@
+# Copyright (c) 2014 Turbulenz Limited
+from logging import getLogger
+from time import time
+
+# pylint: disable=F0401
+from tornado.web import RequestHandler, asynchronous
+from tornado.ioloop import IOLoop
+from pylons import config
+from paste.deploy.converters import asint
+from simplejson import JSONEncoder
+# pylint: enable=F0401
+
+from turbulenz_local.lib.exceptions import ApiException, BadRequest, NotFound
+from turbulenz_local.models.user import User
+from turbulenz_local.models.userlist import get_user
+from turbulenz_local.models.gamelist import get_game_by_slug
+from turbulenz_local.models.apiv1.gamenotifications import GameNotificationTaskListManager, \
+                                                           GameNotificationPathError, \
+                                                           GameNotificationsUnsupportedException
+
+LOG = getLogger(__name__)
+
+# pylint: disable=C0103
+_json_encoder = JSONEncoder(encoding='utf-8', separators=(',',':'))
+# pylint: enable=C0103
+
+# pylint: disable=R0904,W0221,E1103
+class GameNotificationsPollHandler(RequestHandler):
+    """
+    Long polls for the current user's notifications. The request waits on the
+    IO loop until a delayed notification is due, an instant notification is
+    sent or the timeout expires, so clients do not need to keep polling to
+    receive nothing.
+    """
+
+    def initialize(self):
+        self.game = None
+        self.username = None
+        self.deadline = None
+        self.timeout = None
+        self.done = False
+
+    def set_default_headers(self):
+        self.set_header('Server', 'tz')
+        self.set_header('Cache-Control', 'private, max-age=0')
+
+    def _get_timeout(self):
+        max_timeout = asint(config.get('gamenotifications.poll_timeout', 30))
+        try:
+            timeout = float(self.get_argument('timeout', max_timeout))
+        except ValueError:
+            raise BadRequest('Timeout must be a number of seconds')
+        return min(max(timeout, 0), max_timeout)
+
+    def _finish_json(self, data, status=200):
+        self.done = True
+        self.set_status(status)
+        self.set_header('Content-Type', 'application/json; charset=utf-8')
+        self.finish(_json_encoder.encode(data))
+
+    def _remove_timeout(self):
+        if self.timeout is not None:
+            IOLoop.instance().remove_timeout(self.timeout)
+            self.timeout = None
+
+    def _on_task_added(self):
+        # called by the task list while it is locked and possibly from another thread
+        IOLoop.instance().add_callback(self._poll)
+
+    def _poll(self):
+        if self.done:
+            return
+        self._remove_timeout()
+
+        (notifications, next_time) = GameNotificationTaskListManager.poll_latest_or_wait(self.game, self.username,
+                                                                                         self._on_task_added)
+        if notifications or time() >= self.deadline:
+            GameNotificationTaskListManager.cancel_wait(self.game, self.username, self._on_task_added)
+            return self._finish_json({'ok': True, 'data': notifications})
+
+        # wake up when the next delayed notification is due, adding a task wakes it up earlier
+        if next_time is None or next_time > self.deadline:
+            next_time = self.deadline
+        self.timeout = IOLoop.instance().add_timeout(next_time, self._poll)
+
+    @asynchronous
+    def get(self, slug):
+        try:
+            game = get_game_by_slug(slug)
+            if not game:
+                raise NotFound('No game with slug %s' % slug)
+
+            self.game = game
+            self.username = get_user(self.get_cookie('local') or User.default_username).username
+            self.deadline = time() + self._get_timeout()
+            self._poll()
+
+        except ApiException as e:
+            data = {'ok': False, 'msg': e.value}
+            if e.json_data:
+                data['data'] = e.json_data
+            self._finish_json(data, int(e.status.split(' ', 1)[0]))
+        except (GameNotificationPathError, GameNotificationsUnsupportedException) as e:
+            LOG.error('Failed polling game notifications: %s', str(e))
+            self._finish_json({'ok': False, 'msg': 'Failed polling game notifications'}, 500)
+
+    def on_connection_close(self):
+        self.done = True
+        self._remove_timeout()
+        if self.game is not None:
+            GameNotificationTaskListManager.cancel_wait(self.game, self.username, self._on_task_added)
@@ -0,0 +1,43 @@
+# Copyright (c) 2014 Turbulenz Limited
+
+from threading import Condition
+
+
+class GroupCommit(object):
+    """ Coalesces the commits of concurrent writers so that a single call to sync makes all of the writes
+        finished before it durable. The first writer to commit runs sync while the writers that commit
+        during it wait and are all covered by the next sync.
+    """
+
+    def __init__(self, sync):
+        self.sync = sync
+        self._condition = Condition()
+        # the number of commits requested and covered by a finished sync
+        self._requested = 0
+        self._synced = 0
+        self._syncing = False
+
+    def commit(self):
+        """ Blocks until a sync started after the call has finished, raises the sync's error if it fails """
+        condition = self._condition
+        with condition:
+            self._requested += 1
+            commit_id = self._requested
+            while self._synced < commit_id:
+                if self._syncing:
+                    condition.wait()
+                    continue
+
+                # every commit requested so far is covered by this sync
+                self._syncing = True
+                synced = self._requested
+                condition.release()
+                try:
+                    self.sync()
+                finally:
+                    condition.acquire()
+                    self._syncing = False
+                    # if the sync failed one of the waiting writers retries it
+                    condition.notify_all()
+                self._synced = max(self._synced, synced)
+                condition.notify_all()
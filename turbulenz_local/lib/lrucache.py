@@ -0,0 +1,101 @@
+# Copyright (c) 2014 Turbulenz Limited
+
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache(object):
+    """ A thread safe cache that drops the least recently used entries once the total size of the entries is
+        more than max_size, get_size returns the size of a value and by default every value has a size of 1
+    """
+
+    # the number of generation counters the keys are spread over, see set
+    generation_stripes = 256
+
+    def __init__(self, max_size, get_size=None):
+        self.max_size = max_size
+        self.get_size = get_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # the counter of a key's stripe is incremented whenever the key is removed, see set
+        self._generations = [0] * self.generation_stripes
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                (value, size) = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # move the entry to the most recently used end
+            self._entries[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def _get_stripe(self, key):
+        return hash(key) % self.generation_stripes
+
+    def get_generation(self, key):
+        with self._lock:
+            return self._generations[self._get_stripe(key)]
+
+    def set(self, key, value, generation=None):
+        """ Values read before an entry was removed may be out of date, so callers can pass the generation
+            of the key from before they read the value and the value is only added if the key was not removed
+            since. Keys share their generation with the other keys in their stripe so removing a key only stops
+            adding the values of the few keys in its stripe.
+        """
+        if self.get_size:
+            size = self.get_size(value)
+        else:
+            size = 1
+
+        with self._lock:
+            if generation is not None and generation != self._generations[self._get_stripe(key)]:
+                return
+
+            entries = self._entries
+            try:
+                self.size -= entries.pop(key)[1]
+            except KeyError:
+                pass
+
+            if size > self.max_size:
+                return
+
+            entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                self.size -= entries.popitem(last=False)[1][1]
+
+    def remove(self, key):
+        with self._lock:
+            self._generations[self._get_stripe(key)] += 1
+            try:
+                self.size -= self._entries.pop(key)[1]
+            except KeyError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            generations = self._generations
+            for stripe in xrange(self.generation_stripes):
+                generations[stripe] += 1
+            self._entries.clear()
+            self.size = 0
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'size': self.size,
+                'maxSize': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses
+            }
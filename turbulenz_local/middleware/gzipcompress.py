@@ -12,7 +12,7 @@ from os.path import join, normpath
 from paste.deploy.converters import asint, aslist
 # pylint: enable=F0401
 
-from turbulenz_local.tools import compress_file
+from turbulenz_local.tools import compress_file, accepts_gzip
 
 
 LOG = logging.getLogger(__name__)
@@ -87,7 +87,7 @@ class GzipMiddleware(object):
     def __call__(self, environ, start_response):
 
         # if client does not accept gzip encoding, pass the request through
-        if 'gzip' not in environ.get('HTTP_ACCEPT_ENCODING', ''):
+        if not accepts_gzip(environ):
             return self.app(environ, start_response)
 
         # capture the response headers and setup compression
@@ -113,6 +113,9 @@ class GzipMiddleware(object):
                         # Don't bother with small responses because the gzip file could actually be bigger
                         if int(v) <= 256:
                             return start_response(status, headers, exc_info)
+                    elif k == 'Content-Encoding':
+                        # The response is already compressed
+                        return start_response(status, headers, exc_info)
 
                 if not mimetype:
                     # This has no mimetype.
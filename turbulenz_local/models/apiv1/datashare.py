@@ -5,6 +5,7 @@ LOG = logging.getLogger(__name__)
 
 from re import compile as regex_compile
 from time import time as time
+from bisect import insort, bisect_left
 from os import listdir, remove as remove_file
 from os.path import join as join_path, splitext, exists as path_exists
 
@@ -12,10 +13,12 @@ from threading import Lock
 
 # pylint: disable=F0401
 from pylons import config
+from paste.deploy.converters import asint
 import yaml
+from simplejson import dumps as json_dumps, loads as json_loads
 # pylint: enable=F0401
 
-from turbulenz_local.tools import get_absolute_path, create_dir
+from turbulenz_local.tools import get_absolute_path, create_dir, replace_file
 from turbulenz_local.lib.tools import create_id
 from turbulenz_local.lib.exceptions import BadRequest, NotFound, Forbidden
 
@@ -30,9 +33,14 @@ class DataShare(object):
 
     validate_key = regex_compile('^[A-Za-z0-9]+([\-\.][A-Za-z0-9]+)*$')
 
-    def __init__(self, game):
+    # changes are appended to the journal until it is compacted into the YAML file
+    journal_compact_size = asint(config.get('datashare.journal_compact_size', 65536))
+
+    def __init__(self, game, datashare_list=None):
         self.game = game
         self.lock = Lock()
+        # the GameDataShareList that indexes this datashare
+        self.datashare_list = datashare_list
 
         self.datashare_id = None
         # owners username
@@ -43,12 +51,16 @@ class DataShare(object):
 
         self.joinable = None
         self.path = None
+        self.journal_path = None
+        self.journal_size = 0
         self.store = {}
         self.deleted = False
+        # callback -> the {key: token} the callback is waiting on a change to, see watch
+        self.watchers = {}
 
     @classmethod
-    def create(cls, game, owner):
-        datashare = DataShare(game)
+    def create(cls, game, owner, datashare_list=None):
+        datashare = DataShare(game, datashare_list)
         with datashare.lock:
             datashare.datashare_id = create_id()
             datashare.owner = owner.username
@@ -56,16 +68,23 @@ class DataShare(object):
             datashare.created = time()
             datashare.joinable = True
             datashare.write()
+            datashare._changed()
             return datashare
 
     @classmethod
-    def from_file(cls, game, datashare_id):
-        datashare = DataShare(game)
+    def from_file(cls, game, datashare_id, datashare_list=None):
+        datashare = DataShare(game, datashare_list)
         with datashare.lock:
             datashare.datashare_id = datashare_id
             datashare.load()
+            datashare._changed()
             return datashare
 
+    # must be called with the lock held whenever the users, joinable or deleted change
+    def _changed(self):
+        if self.datashare_list is not None:
+            self.datashare_list.update_index(self)
+
     def datashare_access(self, user):
         username = user.username
         if username not in self.users:
@@ -80,7 +99,8 @@ class DataShare(object):
                 raise Forbidden('Data share with id "%s" is not joinable' % self.datashare_id)
             if user.username not in self.users:
                 self.users.append(user.username)
-            self.write()
+            self._append_journal(self._users_record())
+            self._changed()
 
     def leave(self, user):
         with self.lock:
@@ -91,14 +111,18 @@ class DataShare(object):
             if len(self.users) == 0:
                 self._delete()
             else:
-                self.write()
+                self._append_journal(self._users_record())
+                self._changed()
 
     def _delete(self):
-        try:
-            remove_file(self.path)
-        except OSError:
-            pass
+        for path in (self.get_path(), self.get_journal_path()):
+            try:
+                remove_file(path)
+            except OSError:
+                pass
         self.deleted = True
+        self._changed()
+        self._notify_watchers()
 
     def delete(self):
         with self.lock:
@@ -118,6 +142,11 @@ class DataShare(object):
         self.path = path
         return path
 
+    def get_journal_path(self):
+        if self.journal_path is None:
+            self.journal_path = splitext(self.get_path())[0] + '.journal'
+        return self.journal_path
+
     def load(self):
         path = self.get_path()
         if not path_exists(path):
@@ -135,12 +164,82 @@ class DataShare(object):
             LOG.error('Failed loading datashare file "%s": %s', self.path, str(e))
             raise
 
+        self._replay_journal()
+
+    def _replay_journal(self):
+        journal_path = self.get_journal_path()
+        self.journal_size = 0
+        if not path_exists(journal_path):
+            return
+
+        try:
+            with open(journal_path, 'r') as f:
+                journal = f.read()
+
+            # the last record can be incomplete if the server stopped while appending it, remove it so that
+            # the next record is not appended to it
+            end = journal.rfind('\n') + 1
+            if end < len(journal):
+                LOG.warning('Ignoring incomplete record at the end of datashare journal "%s"', journal_path)
+                with open(journal_path, 'r+') as f:
+                    f.truncate(end)
+                journal = journal[:end]
+        except IOError as e:
+            LOG.error('Failed loading datashare journal "%s": %s', journal_path, str(e))
+            raise
+
+        store = self.store
+        for record in journal.splitlines():
+            try:
+                record = json_loads(record)
+                if 'set' in record:
+                    store[record['set']] = record['data']
+                elif 'remove' in record:
+                    store.pop(record['remove'], None)
+                else:
+                    self.users = record['users']
+                    self.joinable = record['joinable']
+            except (ValueError, KeyError, TypeError):
+                LOG.warning('Ignoring invalid record in datashare journal "%s"', journal_path)
+
+        self.journal_size = end
+
+    def _users_record(self):
+        return {'users': self.users, 'joinable': self.joinable}
+
+    # only the change is appended to the journal rather than writing every key to the YAML file
+    def _append_journal(self, record):
+        journal_path = self.get_journal_path()
+        record = json_dumps(record, separators=(',', ':')) + '\n'
+        try:
+            with open(journal_path, 'a') as f:
+                f.write(record)
+        except IOError as e:
+            LOG.error('Failed writing datashare journal "%s": %s', journal_path, str(e))
+            raise
+
+        self.journal_size += len(record)
+        if self.journal_size > self.journal_compact_size:
+            self._compact()
+
+    def _compact(self):
+        journal_path = self.get_journal_path()
+        try:
+            self.write()
+            # replaying the journal over the new YAML file gives the same keys so a failure here is harmless
+            remove_file(journal_path)
+            self.journal_size = 0
+        except (IOError, OSError) as e:
+            LOG.error('Failed compacting datashare journal "%s": %s', journal_path, str(e))
+
     def write(self):
         path = self.get_path()
+        tmp_path = path + '.tmp'
         try:
-            with open(path, 'w') as f:
+            with open(tmp_path, 'w') as f:
                 yaml.dump(self.to_dict(), f)
-        except IOError as e:
+            replace_file(tmp_path, path)
+        except (IOError, OSError) as e:
             LOG.error('Failed writing datashare file "%s": %s', self.path, str(e))
             raise
 
@@ -187,15 +286,17 @@ class DataShare(object):
             except KeyError:
                 pass
             token = ''
+            self._append_journal({'remove': key})
         else:
             token = create_id()
-            self.store[key] = {
+            key_store = self.store[key] = {
                 'ownedBy': owner,
                 'value': value,
                 'access': access,
                 'token': token
             }
-        self.write()
+            self._append_journal({'set': key, 'data': key_store})
+        self._notify_watchers(key)
         return token
 
     def set(self, user, key, value):
@@ -257,16 +358,91 @@ class DataShare(object):
 
             return self.store.get(key)
 
+    def get_many(self, user, keys):
+        """ Returns the key -> stored value and token of the keys that exist """
+        validate_key = self.validate_key
+        for key in keys:
+            if not isinstance(key, basestring):
+                raise BadRequest('Key must be a string')
+            if not validate_key.match(key):
+                raise BadRequest('Key can only contain alphanumeric characters hyphens and dots')
+
+        with self.lock:
+            self.datashare_access(user)
+            store = self.store
+            return dict((key, store[key]) for key in keys if key in store)
+
     def get_keys(self, user):
         with self.lock:
             self.datashare_access(user)
             return [self.key_summary_dict(key) for key in self.store.iterkeys()]
 
+    def _validate_key_tokens(self, key_tokens):
+        if not isinstance(key_tokens, dict) or len(key_tokens) == 0:
+            raise BadRequest('Keys must be an object of keys and the last tokens read for them')
+        for (key, token) in key_tokens.iteritems():
+            if not self.validate_key.match(key):
+                raise BadRequest('Key can only contain alphanumeric characters hyphens and dots')
+            if token is not None and not isinstance(token, basestring):
+                raise BadRequest('Token for key "%s" must be a string' % key)
+
+    def _get_key_changes(self, key_tokens):
+        changes = []
+        store = self.store
+        for (key, token) in key_tokens.iteritems():
+            key_store = store.get(key)
+            if key_store is None:
+                # the key has been removed since it was read
+                if token:
+                    changes.append({'key': key, 'token': ''})
+            elif key_store['token'] != token:
+                key_change = dict(key_store)
+                key_change['key'] = key
+                changes.append(key_change)
+        return changes
+
+    # must be called with the lock held
+    def _notify_watchers(self, key=None):
+        watchers = self.watchers
+        if not watchers:
+            return
+
+        for (callback, key_tokens) in watchers.items():
+            if self.deleted:
+                del watchers[callback]
+                callback(None)
+            elif key is None or key in key_tokens:
+                changes = self._get_key_changes(key_tokens)
+                if changes:
+                    del watchers[callback]
+                    callback(changes)
+
+    def watch(self, user, key_tokens, callback):
+        """ Returns the changes to the keys if any of their tokens differ from key_tokens, otherwise returns
+            an empty list and calls callback once with the changes when one of the keys is next changed or
+            with None if the datashare is deleted. Callback is called with the lock held so it must not block.
+        """
+        with self.lock:
+            if self.deleted:
+                raise NotFound('No data share with id "%s"' % self.datashare_id)
+            self.datashare_access(user)
+            self._validate_key_tokens(key_tokens)
+
+            changes = self._get_key_changes(key_tokens)
+            if not changes:
+                self.watchers[callback] = key_tokens
+            return changes
+
+    def unwatch(self, callback):
+        with self.lock:
+            self.watchers.pop(callback, None)
+
     def set_joinable(self, user, joinable):
         with self.lock:
             self.datashare_access(user)
             self.joinable = joinable
-            self.write()
+            self._append_journal(self._users_record())
+            self._changed()
 
     def reload(self):
         with self.lock:
@@ -274,14 +450,32 @@ class DataShare(object):
                 self.load()
             except NotFound:
                 self._delete()
+            else:
+                self._changed()
+                self._notify_watchers()
 
 
 class GameDataShareList(object):
 
+    max_find_results = 64
+
     def __init__(self, game):
         self.game = game
         self.datashares = {}
         self.lock = Lock()
+        # set once every datashare file has been loaded
+        self.loaded = False
+
+        # the indexes used by find, the datashares update them through update_index when they change so the
+        # index lock is only ever taken last
+        self.index_lock = Lock()
+        # (-created, datashare_id) of every datashare so the newest are first
+        self.created_index = []
+        self.joinable_ids = set()
+        # username -> the ids of the datashares the user has joined
+        self.user_datashare_ids = {}
+        # datashare_id -> the (created entry, users) the datashare is indexed by
+        self.indexed = {}
 
         self.path = self.create_path()
 
@@ -301,37 +495,91 @@ class GameDataShareList(object):
 
     def get_datashare_ids(self):
         try:
-            return [splitext(filename)[0] for filename in listdir(self.path)]
+            return [datashare_id for (datashare_id, ext) in (splitext(filename) for filename in listdir(self.path))
+                    if ext == '.yaml']
         except OSError:
             self.create_path()
             return []
 
     def load_all(self):
+        if self.loaded:
+            return
         for datashare_id in self.get_datashare_ids():
             self.load_id(datashare_id)
+        self.loaded = True
 
     def load_id(self, datashare_id):
         if datashare_id in self.datashares:
             return self.datashares[datashare_id]
 
-        datashare = DataShare.from_file(self.game, datashare_id)
+        datashare = DataShare.from_file(self.game, datashare_id, self)
         self.datashares[datashare_id] = datashare
         return datashare
 
+    # must be called with the index lock held
+    def _remove_index(self, datashare_id):
+        try:
+            (created_entry, users) = self.indexed.pop(datashare_id)
+        except KeyError:
+            return
+
+        created_index = self.created_index
+        del created_index[bisect_left(created_index, created_entry)]
+        self.joinable_ids.discard(datashare_id)
+        user_datashare_ids = self.user_datashare_ids
+        for username in users:
+            datashare_ids = user_datashare_ids[username]
+            datashare_ids.discard(datashare_id)
+            if not datashare_ids:
+                del user_datashare_ids[username]
+
+    def update_index(self, datashare):
+        datashare_id = datashare.datashare_id
+        with self.index_lock:
+            self._remove_index(datashare_id)
+            if datashare.deleted:
+                return
+
+            created_entry = (-datashare.created, datashare_id)
+            users = frozenset(datashare.users)
+            insort(self.created_index, created_entry)
+            if datashare.joinable:
+                self.joinable_ids.add(datashare_id)
+            user_datashare_ids = self.user_datashare_ids
+            for username in users:
+                try:
+                    user_datashare_ids[username].add(datashare_id)
+                except KeyError:
+                    user_datashare_ids[username] = set([datashare_id])
+            self.indexed[datashare_id] = (created_entry, users)
+
     def find(self, user, username_to_find=None):
         with self.lock:
             self.load_all()
 
-            result = []
-            for datashare in self.datashares.itervalues():
+        max_results = self.max_find_results
+        with self.index_lock:
+            joinable_ids = self.joinable_ids
+            user_ids = self.user_datashare_ids.get(user.username, ())
+            if username_to_find is None:
+                created_entries = self.created_index
+            else:
+                # only the datashares joined by the user to find need to be ordered
+                indexed = self.indexed
+                created_entries = sorted(indexed[datashare_id][0]
+                                         for datashare_id in self.user_datashare_ids.get(username_to_find, ()))
+
+            result_ids = []
+            for (_, datashare_id) in created_entries:
                 # only display joinable datashares or datashares that the current user is already joined to
-                if datashare.joinable or user.username in datashare.users:
-                    if username_to_find == None or username_to_find in datashare.users:
-                        result.append(datashare)
-                        result.sort(key=lambda a: -a.created)
-                        if len(result) > 64:
-                            del result[64]
-            return result
+                if datashare_id in joinable_ids or datashare_id in user_ids:
+                    result_ids.append(datashare_id)
+                    if len(result_ids) == max_results:
+                        break
+
+        with self.lock:
+            datashares = self.datashares
+            return [datashares[datashare_id] for datashare_id in result_ids if datashare_id in datashares]
 
     def get(self, datashare_id):
         with self.lock:
@@ -339,7 +587,7 @@ class GameDataShareList(object):
 
     def create_datashare(self, user):
         with self.lock:
-            datashare = DataShare.create(self.game, user)
+            datashare = DataShare.create(self.game, user, self)
             self.datashares[datashare.datashare_id] = datashare
             return datashare
 
@@ -368,6 +616,9 @@ class GameDataShareList(object):
             for datashare_id in deleted_datashares:
                 del self.datashares[datashare_id]
 
+            # datashare files added since they were loaded are only found by loading them again
+            self.loaded = False
+
 
 class DataShareList(object):
     game_datashares = {}
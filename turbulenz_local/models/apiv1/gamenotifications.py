@@ -7,6 +7,7 @@ from os import access, R_OK, remove as remove_file, listdir
 from os.path import join as join_path, normpath as norm_path
 from threading import Lock
 from time import time as get_time
+from heapq import heapify, heappush, heappop
 
 from simplejson import JSONEncoder, JSONDecoder
 
@@ -237,158 +238,221 @@ class GameNotificationTask(object):
 
 class GameNotificationTaskList(object):
 
-    def __init__(self, slug, recipient):
+    def __init__(self, slug, recipient, task_index=None):
         object.__init__(self)
 
         self._slug = slug
         self._recipient = recipient
         self._lock = Lock()
 
+        # task_id -> (recipient, task) of the tasks of every recipient of the game, shared by their task lists
+        if task_index is None:
+            task_index = {}
+        self._task_index = task_index
+
         instant = GameNotificationTask.INSTANT
         delayed = GameNotificationTask.DELAYED
 
-        instant_tasks, instant_task_ids, num_instant_tasks_per_sender = \
+        instant_tasks, _, num_instant_tasks_per_sender = \
             _load_tasks(slug, recipient, GameNotificationTask.INSTANT)
 
-        delayed_tasks, delayed_task_ids, num_delayed_tasks_per_sender = \
+        delayed_tasks, _, num_delayed_tasks_per_sender = \
             _load_tasks(slug, recipient, GameNotificationTask.DELAYED)
 
-        self._tasks = {
-            instant: instant_tasks,
-            delayed: delayed_tasks
-        }
+        # task_id -> task of the tasks that have not been sent or cancelled
+        self._tasks = {}
+        # key -> the ids of the tasks with that key
+        self._key_task_ids = defaultdict(set)
+        for task in instant_tasks + delayed_tasks:
+            self._index_task(task)
 
-        self._task_ids = {
-            instant: instant_task_ids,
-            delayed: delayed_task_ids
-        }
+        # (send time, task_id) of the tasks so that the next task to send is first, instant tasks have a send time
+        # of 0 so they are always first. Removed tasks are left in the heap until they reach the top of it.
+        self._schedule = []
+        self._build_schedule()
 
         self._num_tasks_per_sender = {
             instant: num_instant_tasks_per_sender,
             delayed: num_delayed_tasks_per_sender
         }
 
+        # callbacks waiting for a task to be added, see poll_latest_or_wait
+        self._waiters = set()
+
+
+    @classmethod
+    def _get_send_time(cls, task):
+        return task.time or 0
+
+
+    # must be called with the lock held
+    def _index_task(self, task):
+        task_id = task.task_id
+        self._tasks[task_id] = task
+        self._key_task_ids[task.key].add(task_id)
+        self._task_index[task_id] = (self._recipient, task)
+
+
+    # must be called with the lock held
+    def _build_schedule(self):
+        get_send_time = self._get_send_time
+        self._schedule = [(get_send_time(task), task_id) for (task_id, task) in self._tasks.iteritems()]
+        heapify(self._schedule)
+
+
+    # must be called with the lock held, returns the next task to send or None
+    def _peek_task(self):
+        schedule = self._schedule
+        tasks = self._tasks
+        while schedule:
+            task = tasks.get(schedule[0][1])
+            if task is not None:
+                return task
+            # the task was removed
+            heappop(schedule)
+        return None
+
 
     def add_task(self, task):
         notification_type = task.notification_type
         sender = task.sender
 
-
-        if self._num_tasks_per_sender[notification_type][sender] >= task.LIMIT[notification_type]:
-            return False
-
         with self._lock:
+            if self._num_tasks_per_sender[notification_type][sender] >= task.LIMIT[notification_type]:
+                return False
+
             ## save task to disk
             task.save()
 
-            ## and add it to the list. This looks stupid but is much more efficient than appending and re-sorting.
-            sendtime = task.time
-            index = 0
-            tasks = self._tasks[notification_type]
-
-            for index, old_task in enumerate(tasks):
-                if old_task.time > sendtime:
-                    break
-
-            tasks.insert(index, task)
-            self._task_ids[notification_type].add(task.task_id)
+            self._index_task(task)
+            heappush(self._schedule, (self._get_send_time(task), task.task_id))
             self._num_tasks_per_sender[notification_type][sender] += 1
 
+            # the waiting polls check if the new task is due or reschedule themselves for it
+            waiters = self._waiters
+            self._waiters = set()
+            for callback in waiters:
+                callback()
+
             return True
 
 
-    def poll_latest(self):
+    # must be called with the lock held
+    def _poll_latest(self):
         current_time = get_time()
         tasks = []
-        tasks_to_delete = []
-        for tasks_by_type in self._tasks.itervalues():
-            for task in tasks_by_type:
+        while True:
+            task = self._peek_task()
+            if task is None or current_time < task.time:
+                break
+            heappop(self._schedule)
+            tasks.append(task.to_notification())
+            self._remove_task(task)
+        return tasks
 
-                if current_time < task.time:
-                    break
 
-                tasks.append(task.to_notification())
-                tasks_to_delete.append(task)
+    def poll_latest(self):
+        with self._lock:
+            return self._poll_latest()
 
 
-        for task in tasks_to_delete:
-            self.remove_task(task)
+    def poll_latest_or_wait(self, callback):
+        """ Returns the notifications that are due and the time the next delayed task is due or None. If no
+            notifications are due then callback is called once the next task is added, it is called with the lock
+            held so it must not block.
+        """
+        with self._lock:
+            tasks = self._poll_latest()
+            if not tasks:
+                self._waiters.add(callback)
 
-        return tasks
+            next_task = self._peek_task()
+            if next_task is None:
+                return tasks, None
+            return tasks, next_task.time
 
 
-    def cancel_notification_by_id(self, task_id):
+    def cancel_wait(self, callback):
+        with self._lock:
+            self._waiters.discard(callback)
 
-        for tasks_by_type in self._tasks.itervalues():
-            for task in tasks_by_type:
 
-                if task.task_id == task_id:
-                    self.remove_task(task)
-                    break
+    def cancel_notification_by_id(self, task_id):
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is not None:
+                self._remove_task(task)
 
 
     def cancel_notification_by_key(self, key):
-
-        for tasks_by_type in self._tasks.itervalues():
-            tasks_to_remove = [task for task in tasks_by_type if task.key == key]
-
-        for task in tasks_to_remove:
-            self.remove_task(task)
+        with self._lock:
+            tasks = self._tasks
+            for task_id in list(self._key_task_ids.get(key, ())):
+                self._remove_task(tasks[task_id])
 
 
     def cancel_all_notifications(self):
-        for task_type, tasks_by_type in self._tasks.iteritems():
-            for task in tasks_by_type:
+        with self._lock:
+            task_index = self._task_index
+            for (task_id, task) in self._tasks.iteritems():
+                task_index.pop(task_id, None)
                 task.remove()
 
-            self._tasks[task_type] = []
-            self._task_ids[task_type].clear()
-            self._num_tasks_per_sender[task_type].clear()
+            self._tasks = {}
+            self._key_task_ids.clear()
+            self._schedule = []
+            for num_tasks_per_sender in self._num_tasks_per_sender.itervalues():
+                num_tasks_per_sender.clear()
 
 
     def cancel_all_pending_notifications(self):
         current_time = get_time()
 
-        tasks_to_delete = []
-
-        for tasks_by_type in self._tasks.itervalues():
-            for task in tasks_by_type:
+        with self._lock:
+            for task in [task for task in self._tasks.itervalues() if current_time < task.time]:
+                self._remove_task(task)
 
-                if current_time < task.time:
-                    tasks_to_delete.append(task)
-                else:
-                    break
 
-        for task in tasks_to_delete:
-            self.remove_task(task)
+    def has_task(self, task_id):
+        return task_id in self._tasks
 
 
-    def has_task(self, task_id):
-        for task_ids in self._task_ids.itervalues():
-            if task_id in task_ids:
-                return True
-        return False
+    # must be called with the lock held
+    def _remove_task(self, task):
+        task_id = task.task_id
+        del self._tasks[task_id]
+        self._task_index.pop(task_id, None)
+        key_task_ids = self._key_task_ids[task.key]
+        key_task_ids.discard(task_id)
+        if not key_task_ids:
+            del self._key_task_ids[task.key]
+        self._num_tasks_per_sender[task.notification_type][task.sender] -= 1
 
+        task.remove()
 
-    def remove_task(self, task):
-        notification_type = task.notification_type
+        # drop the removed tasks from the schedule once they outnumber the tasks
+        if len(self._schedule) > 2 * len(self._tasks) + 64:
+            self._build_schedule()
 
-        self._tasks[notification_type].remove(task)
-        self._task_ids[notification_type].remove(task.task_id)
-        self._num_tasks_per_sender[notification_type][task.sender] -= 1
 
-        task.remove()
+    def remove_task(self, task):
+        with self._lock:
+            if task.task_id in self._tasks:
+                self._remove_task(task)
 
 
 
 class GameNotificationTaskListManager(object):
 
-    gnt_lists = defaultdict(lambda: {})
+    gnt_lists = defaultdict(dict)
+    # slug -> task_id -> (recipient, task) of the tasks of the loaded task lists
+    task_indexes = defaultdict(dict)
 
     @classmethod
     def load(cls, game, recipient):
-        tasks = GameNotificationTaskList(game.slug, recipient)
-        cls.gnt_lists[game.slug][recipient] = tasks
+        slug = game.slug
+        tasks = GameNotificationTaskList(slug, recipient, cls.task_indexes[slug])
+        cls.gnt_lists[slug][recipient] = tasks
         return tasks
 
 
@@ -402,7 +466,8 @@ class GameNotificationTaskListManager(object):
 
     @classmethod
     def reset(cls):
-        cls.gnt_lists = {}
+        cls.gnt_lists = defaultdict(dict)
+        cls.task_indexes = defaultdict(dict)
 
 
     @classmethod
@@ -418,17 +483,27 @@ class GameNotificationTaskListManager(object):
         return tasklist.poll_latest()
 
 
+    @classmethod
+    def poll_latest_or_wait(cls, game, recipient, callback):
+        tasklist = cls.get(game, recipient)
+        return tasklist.poll_latest_or_wait(callback)
+
+
+    @classmethod
+    def cancel_wait(cls, game, recipient, callback):
+        cls.get(game, recipient).cancel_wait(callback)
+
+
     @classmethod
     def cancel_notification_by_id(cls, game, task_id):
 
-        slug = game.slug
-        if slug in cls.gnt_lists:
-            for task_list in cls.gnt_lists[slug].itervalues():
-                if task_list.has_task(task_id):
-                    task_list.cancel_notification_by_id(task_id)
-                    return True
+        try:
+            (recipient, _) = cls.task_indexes[game.slug][task_id]
+        except KeyError:
+            return False
 
-        return False
+        cls.gnt_lists[game.slug][recipient].cancel_notification_by_id(task_id)
+        return True
 
 
     @classmethod
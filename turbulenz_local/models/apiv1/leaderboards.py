@@ -4,24 +4,47 @@ import logging
 LOG = logging.getLogger(__name__)
 
 from re import compile as regex_compile
+from array import array
+from struct import Struct, error as StructError
+from itertools import izip, imap, islice, chain, count
+from operator import le, attrgetter
+from sys import byteorder
 from time import time as time_now
-from os.path import exists as path_exists, join as join_path, splitext
+from os import fsync, remove as remove_file
+from os.path import exists as path_exists, join as join_path, splitext, getmtime
 
 from math import floor, ceil, isinf, isnan
+from bisect import bisect_left, bisect_right
+from heapq import heapify, heappush, heappop
 
-from threading import Lock
+from threading import Lock, Thread
 
 # pylint: disable=F0401
 from pylons import config
+from paste.deploy.converters import asint
 import yaml
 # pylint: enable=F0401
 
-from turbulenz_local.tools import get_absolute_path, create_dir
+from turbulenz_local.tools import get_absolute_path, create_dir, replace_file
 from turbulenz_local.lib.validation import ValidationException
-from turbulenz_local.models.userlist import get_user
+from turbulenz_local.models.userlist import get_user_summary
 
 REQUIRED_LEADERBOARD_KEYS = ['key', 'title']
 
+LEADERBOARD_FORMATS = ['yaml', 'binary']
+
+# the named rolling windows in seconds, windows can also be given as a number of seconds
+LEADERBOARD_WINDOWS = {'daily': 86400, 'weekly': 604800}
+
+# binary leaderboard files are a header followed by the newline separated UTF-8 usernames
+# and then the little endian float64 score and time columns in the same order, best score first
+BINARY_MAGIC = 'TZLB'
+BINARY_VERSION = 1
+BINARY_HEADER = Struct('<4sIII')
+
+# versions are shared by all of the leaderboards so that a version is never reused after a reload
+_VERSIONS = count(1)
+
 
 class LeaderboardError(Exception):
     def __init__(self, value, response_code=400):
@@ -39,6 +62,9 @@ class LeaderboardsUnsupported(LeaderboardError):
 
 
 class UserScore(object):
+    # boards can hold hundreds of thousands of scores
+    __slots__ = ('user', 'score', 'score_time')
+
     def __init__(self, username, score, score_time):
         self.user = username
         self.score = score
@@ -53,20 +79,152 @@ class UserScore(object):
                 'time': self.score_time}
 
 
+def _encode_username(username):
+    if isinstance(username, unicode):
+        return username.encode('utf-8')
+    return str(username)
+
+
+def _decode_username(username):
+    # ASCII usernames are kept as str like the usernames read from YAML
+    try:
+        username.decode('ascii')
+        return username
+    except UnicodeDecodeError:
+        return username.decode('utf-8')
+
+
+def read_binary_scores(path):
+    f = open(path, 'rb')
+    try:
+        header = f.read(BINARY_HEADER.size)
+        if len(header) == 0:
+            # emptied leaderboard
+            return [], array('d'), array('d')
+
+        try:
+            (magic, version, num_scores, usernames_size) = BINARY_HEADER.unpack(header)
+        except StructError:
+            raise ValueError('File header is truncated')
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            raise ValueError('Unsupported file format')
+
+        usernames = f.read(usernames_size)
+        scores = array('d')
+        times = array('d')
+        try:
+            scores.fromfile(f, num_scores)
+            times.fromfile(f, num_scores)
+        except EOFError:
+            raise ValueError('File is truncated')
+    finally:
+        f.close()
+
+    if num_scores > 0:
+        try:
+            decoded_usernames = usernames.decode('utf-8')
+        except UnicodeDecodeError:
+            raise ValueError('Usernames are not UTF-8 encoded')
+        # ASCII usernames are kept as str like the usernames read from YAML
+        if len(decoded_usernames) == len(usernames):
+            usernames = usernames.split('\n')
+        else:
+            usernames = decoded_usernames.split(u'\n')
+    else:
+        usernames = []
+
+    if len(usernames) != num_scores:
+        raise ValueError('Expected %d usernames but found %d' % (num_scores, len(usernames)))
+
+    if byteorder == 'big':
+        scores.byteswap()
+        times.byteswap()
+
+    return usernames, scores, times
+
+
+def write_binary_scores(f, user_scores):
+    usernames = '\n'.join([_encode_username(s.user) for s in user_scores])
+    scores = array('d', [s.score for s in user_scores])
+    times = array('d', [s.score_time for s in user_scores])
+
+    if byteorder == 'big':
+        scores.byteswap()
+        times.byteswap()
+
+    f.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(user_scores), len(usernames)))
+    f.write(usernames)
+    scores.tofile(f)
+    times.tofile(f)
+
+
+class LeaderboardFiles(object):
+    """ The state of a leaderboard's snapshot and journal files. Reloading a game's leaderboards creates new
+        Leaderboard objects for the same files while a compaction started by the old objects may still be running,
+        so the state is shared by every Leaderboard object for the files and kept for the life of the server.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        # accepted scores are appended to the journal until it is compacted into the snapshot file
+        self.journal_size = 0
+        self.compacting = False
+        # incremented when the leaderboard is emptied so that running compactions are discarded
+        self.generation = 0
+
+
 class Leaderboard(object):
 
     validate_key = regex_compile('^[A-Za-z0-9]+([\-\.][A-Za-z0-9]+)*$')
 
+    # the files of each leaderboard that has been loaded, keyed by game slug and leaderboard key
+    leaderboard_files = {}
+    leaderboard_files_lock = Lock()
+
     def __init__(self, game, key, meta_data, index):
         self.user_scores = {}
+        # scores are kept sorted with their sort keys in a parallel list for bisecting
         self.scores = []
+        self.score_keys = []
+        self.loaded = False
         self.aggregate = False
         self.aggregate_score = 0
-        self.lock = Lock()
+
+        with self.leaderboard_files_lock:
+            try:
+                self.files = self.leaderboard_files[(game.slug, key)]
+            except KeyError:
+                self.files = self.leaderboard_files[(game.slug, key)] = LeaderboardFiles()
+        # the lock of the files as the loaded scores are read from and written to them
+        self.lock = self.files.lock
+
+        # windowed leaderboards only keep scores set within the last window seconds, the expiry heap
+        # holds the (time, username) of every score set in the window ordered by when they expire
+        self.window = None
+        self.expiry = []
+        # the scores each user set in the window that could become their best, oldest and best first,
+        # so that when a users best score expires their next best score is promoted to the board
+        self.window_scores = {}
+        self.next_expiry = float('inf')
+
+        # increases whenever the scores change
+        self.version = next(_VERSIONS)
+        # the cached user overviews, an overview is removed when a score change could change its rank
+        self.overviews = {}
+
+        self.journal_compact_size = asint(config.get('leaderboards.journal_compact_size', 1048576))
+
+        self.format = config.get('leaderboards.format', 'yaml')
+        if self.format not in LEADERBOARD_FORMATS:
+            LOG.error('leaderboards.format must be one of %s', ', '.join(LEADERBOARD_FORMATS))
+            self.format = 'yaml'
 
         self.errors = []
         self.warnings = []
         self.path = None
+        self.yaml_path = None
+        self.binary_path = None
+        self.journal_path = None
 
         def error(msg):
             self.errors.append(msg)
@@ -106,6 +264,18 @@ class Leaderboard(object):
             sort_by = 1
         self.sort_by = sort_by
 
+        window = meta_data.get('window')
+        if window is not None:
+            try:
+                window = LEADERBOARD_WINDOWS[window]
+            except (KeyError, TypeError):
+                pass
+            if isinstance(window, (int, float)) and not isinstance(window, bool) and window > 0:
+                self.window = window
+            else:
+                error('window must be one of %s or a positive number of seconds for key "%s"'
+                      % (', '.join(sorted(LEADERBOARD_WINDOWS.keys())), key))
+
         if 'icon' in meta_data:
             warning('"icon" yaml property has been deprecated please use '
                     '"icon256", "icon48" or "icon32" for leaderboard key "%s"' % key)
@@ -160,10 +330,13 @@ class Leaderboard(object):
                 continue
 
     def to_dict(self):
-        return {'key': self.key,
-                'index': self.index,
-                'title': self.title,
-                'sortBy': self.sort_by}
+        leaderboard = {'key': self.key,
+                       'index': self.index,
+                       'title': self.title,
+                       'sortBy': self.sort_by}
+        if self.window:
+            leaderboard['window'] = self.window
+        return leaderboard
 
     def _set_path(self):
         if not self.path:
@@ -177,10 +350,21 @@ class Leaderboard(object):
             if not create_dir(path):
                 LOG.error('Game leaderboards path \"%s\" could not be created.', path)
 
-            self.path = join_path(path, self.key + '.yaml')
+            self.yaml_path = join_path(path, self.key + '.yaml')
+            self.binary_path = join_path(path, self.key + '.bin')
+            self.journal_path = join_path(path, self.key + '.journal')
+            if self.format == 'binary':
+                self.path = self.binary_path
+            else:
+                self.path = self.yaml_path
+
+
+    def _get_score_key(self, score, score_time):
+        # best score first, ties are won by the earliest score
+        return (-self.sort_by * score, score_time)
 
 
-    # do not use this function to increase a score
+    # only use this function while loading, the scores must be sorted afterwards
     def _add_score(self, user_score):
         self.user_scores[user_score.user] = user_score
         self.scores.append(user_score)
@@ -188,81 +372,575 @@ class Leaderboard(object):
             self.aggregate_score += user_score.score
 
 
+    def _insert_score(self, user_score):
+        score_key = self._get_score_key(user_score.score, user_score.score_time)
+        index = bisect_right(self.score_keys, score_key)
+        self.score_keys.insert(index, score_key)
+        self.scores.insert(index, user_score)
+        self.user_scores[user_score.user] = user_score
+        if self.aggregate:
+            self.aggregate_score += user_score.score
+
+
+    def _remove_score(self, user_score):
+        index = self._get_index(user_score)
+        del self.score_keys[index]
+        del self.scores[index]
+        del self.user_scores[user_score.user]
+        if self.aggregate:
+            self.aggregate_score -= user_score.score
+
+
+    def _is_better(self, score, other_score):
+        return (score > other_score) if self.sort_by == 1 else (score < other_score)
+
+
+    # returns if the score is the users new best score and the best score it was compared to
+    def _add_window_score(self, user_score):
+        window_scores = self.window_scores
+        username = user_score.user
+        try:
+            candidates = window_scores[username]
+        except KeyError:
+            window_scores[username] = [user_score]
+            return True, None
+
+        best_score = candidates[0]
+        if self._is_better(user_score.score, best_score.score):
+            candidates[:] = [user_score]
+            return True, best_score
+
+        # scores that are no better than the new score expire before it so can never be promoted
+        while len(candidates) > 1 and not self._is_better(candidates[-1].score, user_score.score):
+            candidates.pop()
+        candidates.append(user_score)
+        return False, best_score
+
+
+    def _update_version(self):
+        self.version = next(_VERSIONS)
+
+
+    # must be called after a users score has changed from old_score to new_score, where None is no score
+    def _invalidate_overviews(self, username, old_score, new_score):
+        overviews = self.overviews
+        overviews.pop(username, None)
+        if not overviews:
+            return
+
+        # only the users with scores between the old and new scores are ranked above or below it differently
+        inf = float('inf')
+        sort_by = self.sort_by
+        old_key = -sort_by * old_score if old_score is not None else inf
+        new_key = -sort_by * new_score if new_score is not None else inf
+        low_key = min(old_key, new_key)
+        high_key = max(old_key, new_key)
+        if low_key == high_key:
+            return
+
+        score_keys = self.score_keys
+        start = bisect_right(score_keys, (low_key, inf))
+        end = bisect_right(score_keys, (high_key, inf))
+        if end - start < len(overviews):
+            scores = self.scores
+            for index in xrange(start, end):
+                overviews.pop(scores[index].user, None)
+        else:
+            for (overview_username, overview) in overviews.items():
+                if overview is not None and low_key < -sort_by * overview['score'] <= high_key:
+                    del overviews[overview_username]
+
+
+    def _set_next_expiry(self):
+        expiry = self.expiry
+        if expiry:
+            self.next_expiry = expiry[0][0] + self.window
+        else:
+            self.next_expiry = float('inf')
+
+
+    def _add_expiry(self, user_score):
+        heappush(self.expiry, (user_score.score_time, user_score.user))
+        if len(self.expiry) == 1:
+            self._set_next_expiry()
+
+
+    def _expire_scores(self):
+        if time_now() < self.next_expiry:
+            return
+
+        expiry = self.expiry
+        window_scores = self.window_scores
+        expire_time = time_now() - self.window
+        expired = False
+        while expiry and expiry[0][0] <= expire_time:
+            (_, username) = heappop(expiry)
+            # entries are left in the heap for the scores a user replaced so skip them
+            candidates = window_scores.get(username)
+            if not candidates or candidates[0].score_time > expire_time:
+                continue
+
+            old_score = candidates[0].score
+            self._remove_score(candidates[0])
+            while candidates and candidates[0].score_time <= expire_time:
+                del candidates[0]
+            if candidates:
+                self._insert_score(candidates[0])
+                self._invalidate_overviews(username, old_score, candidates[0].score)
+            else:
+                del window_scores[username]
+                self._invalidate_overviews(username, old_score, None)
+            expired = True
+
+        self._set_next_expiry()
+        if expired:
+            self._update_version()
+
+
+    def _get_index(self, user_score):
+        scores = self.scores
+        index = bisect_left(self.score_keys, self._get_score_key(user_score.score, user_score.score_time))
+        # skip any other users with exactly the same score and time
+        while scores[index] is not user_score:
+            index += 1
+        return index
+
+
+    # the position of a user on the board is found from their score rather than stored per user
+    # because every insert would otherwise have to update the positions of all of the scores below it
+    def _get_user_index(self, username):
+        return self._get_index(self.user_scores[username])
+
+
+    def _get_user_rank(self, username):
+        index = self._get_user_index(username)
+        # the rank is the position of the first score equal to the users score
+        score_key = self.score_keys[index][0]
+        return bisect_left(self.score_keys, (score_key, ), 0, index) + 1
+
+
+    # the leaderboard is kept in memory once read so this must be called with the lock held
     def _read_leaderboard(self):
+        if self.loaded:
+            self._expire_scores()
+            return
+
         self._set_path()
-        with self.lock:
-            self.user_scores = {}
-            self.scores = []
-            self.aggregate_score = 0
+        self.user_scores = {}
+        self.scores = []
+        self.score_keys = []
+        self.aggregate_score = 0
 
-            unicode_path = unicode(self.path)
-            if path_exists(unicode_path):
+        snapshot_format = self._get_snapshot_format()
+        if snapshot_format == 'binary':
+            # binary files are stored sorted so the scores are already in order
+            is_sorted = self._read_binary_leaderboard()
+        else:
+            self._read_yaml_leaderboard()
+            is_sorted = False
+        # leaderboards read from the other format are compacted to convert them to the configured format
+        convert = (snapshot_format is not None and snapshot_format != self.format)
+
+        (journal_scores, self.files.journal_size) = self._read_journal()
+        if self.window:
+            self._replay_window_journal(journal_scores)
+            is_sorted = False
+        else:
+            if len(self.user_scores) != len(self.scores):
+                # boards that used to be windowed can have several scores for each user
+                self._remove_duplicate_scores()
+                is_sorted = False
+            is_sorted = self._replay_journal(journal_scores, is_sorted)
+
+        for s in self.default_scores:
+            username = s.user
+            if username not in self.user_scores:
+                # copy the score so that if the scores are reset then
+                # the default is left unchanged
+                users_score = s.copy()
+                if self.window:
+                    self.window_scores[username] = [users_score]
+                if is_sorted:
+                    self._insert_score(users_score)
+                else:
+                    self._add_score(users_score)
+
+        if not is_sorted:
+            self._sort_scores()
+        self.loaded = True
+
+        if self.window:
+            self.expiry = [(s.score_time, s.user)
+                           for candidates in self.window_scores.itervalues() for s in candidates]
+            heapify(self.expiry)
+            self._set_next_expiry()
+            self._expire_scores()
+
+        if convert:
+            self._start_compaction()
+
+
+    # returns the format of the newest snapshot file or None if there are none
+    def _get_snapshot_format(self):
+        # the journal is only compacted into the configured format so the newest snapshot is the one the
+        # journal was compacted into, even if the format has been changed since
+        snapshot_format = None
+        snapshot_mtime = None
+        for (file_format, path) in (('yaml', self.yaml_path), ('binary', self.binary_path)):
+            try:
+                mtime = getmtime(unicode(path))
+            except OSError:
+                continue
+            if snapshot_format is None or mtime > snapshot_mtime or \
+               (mtime == snapshot_mtime and file_format == self.format):
+                snapshot_format = file_format
+                snapshot_mtime = mtime
+        return snapshot_format
+
+
+    def _read_yaml_leaderboard(self):
+        unicode_path = unicode(self.yaml_path)
+        if path_exists(unicode_path):
+            try:
                 try:
-                    try:
-                        f = open(unicode_path, 'r')
-                        file_leaderboard = yaml.load(f)
+                    f = open(unicode_path, 'r')
+                    file_leaderboard = yaml.load(f)
+
+                    if file_leaderboard:
+                        for s in file_leaderboard:
+                            self._add_score(UserScore(s['user'], s['score'], s['time']))
+                finally:
+                    f.close()
+
+            except (IOError, KeyError, yaml.YAMLError) as e:
+                LOG.error('Failed loading leaderboards file "%s": %s', self.yaml_path, str(e))
+                raise LeaderboardError('Failed loading leaderboard file "%s": %s' % (self.yaml_path, str(e)))
+
+
+    def _read_binary_leaderboard(self):
+        try:
+            (usernames, scores, times) = read_binary_scores(unicode(self.binary_path))
+        except (IOError, ValueError) as e:
+            LOG.error('Failed loading leaderboards file "%s": %s', self.binary_path, str(e))
+            raise LeaderboardError('Failed loading leaderboard file "%s": %s' % (self.binary_path, str(e)))
+
+        # build the board straight from the columns rather than a row at a time
+        self.scores = map(UserScore, usernames, scores, times)
+        self.user_scores = dict(izip(usernames, self.scores))
+        if self.aggregate:
+            self.aggregate_score = sum(scores)
 
-                        if file_leaderboard:
-                            for s in file_leaderboard:
-                                self._add_score(UserScore(s['user'], s['score'], s['time']))
-                    finally:
-                        f.close()
+        if self.sort_by == 1:
+            score_keys = zip([-s for s in scores], times)
+        else:
+            score_keys = zip(scores, times)
+        self.score_keys = score_keys
+
+        # returns if the scores are sorted, which is only untrue for files not written by the server
+        return all(imap(le, score_keys, islice(score_keys, 1, None)))
+
+
+    def _remove_duplicate_scores(self):
+        get_score_key = self._get_score_key
+        user_scores = {}
+        for s in self.scores:
+            users_score = user_scores.get(s.user)
+            if users_score is None or \
+               get_score_key(s.score, s.score_time) < get_score_key(users_score.score, users_score.score_time):
+                user_scores[s.user] = s
+
+        self.user_scores = user_scores
+        self.scores = user_scores.values()
+        if self.aggregate:
+            self.aggregate_score = sum([s.score for s in self.scores])
+
+
+    # returns the journaled scores in the order they were set and the size of the journal
+    def _read_journal(self):
+        unicode_path = unicode(self.journal_path)
+        if not path_exists(unicode_path):
+            return [], 0
 
-                except (IOError, KeyError, yaml.YAMLError) as e:
-                    LOG.error('Failed loading leaderboards file "%s": %s', self.path, str(e))
-                    raise LeaderboardError('Failed loading leaderboard file "%s": %s' % (self.path, str(e)))
+        try:
+            f = open(unicode_path, 'r')
+            try:
+                journal = f.read()
+            finally:
+                f.close()
+        except IOError as e:
+            LOG.error('Failed loading leaderboard journal "%s": %s', self.journal_path, str(e))
+            raise LeaderboardError('Failed loading leaderboard journal "%s": %s' % (self.journal_path, str(e)))
+
+        journal_scores = []
+        for record in journal.splitlines():
+            try:
+                (username, score, score_time) = record.split(' ')
+                journal_scores.append(UserScore(_decode_username(username), float(score), float(score_time)))
+            except ValueError:
+                # the last record can be incomplete if the server stopped while appending it
+                LOG.warning('Ignoring invalid record in leaderboard journal "%s"', self.journal_path)
+
+        return journal_scores, len(journal)
+
+
+    # returns if the scores are still sorted after replaying the journal
+    def _replay_journal(self, journal_scores, is_sorted):
+        # each record is a new best score for its user so only the best record for each user is replayed
+        get_score_key = self._get_score_key
+        best_scores = {}
+        for s in journal_scores:
+            best_score = best_scores.get(s.user)
+            if best_score is None or \
+               get_score_key(s.score, s.score_time) < get_score_key(best_score.score, best_score.score_time):
+                best_scores[s.user] = s
+
+        # inserting a score moves every score below it so a long journal is cheaper to sort in
+        if is_sorted and len(best_scores) * 256 > len(self.scores):
+            is_sorted = False
+
+        user_scores = self.user_scores
+        for s in best_scores.itervalues():
+            try:
+                users_score = user_scores[s.user]
+            except KeyError:
+                if is_sorted:
+                    self._insert_score(s)
+                else:
+                    self._add_score(s)
+                continue
 
+            if get_score_key(s.score, s.score_time) >= get_score_key(users_score.score, users_score.score_time):
+                continue
+            if is_sorted:
+                self._remove_score(users_score)
+                users_score.score = s.score
+                users_score.score_time = s.score_time
+                self._insert_score(users_score)
             else:
-                self.user_scores = {}
-                self.scores = []
+                if self.aggregate:
+                    self.aggregate_score += s.score - users_score.score
+                users_score.score = s.score
+                users_score.score_time = s.score_time
 
-            for s in self.default_scores:
-                username = s.user
-                if username not in self.user_scores:
-                    # copy the score so that if the scores are reset then
-                    # the default is left unchanged
-                    self._add_score(s.copy())
+        return is_sorted
 
-            self._sort_scores()
+
+    def _replay_window_journal(self, journal_scores):
+        # the snapshot and journal hold every score that could still be promoted, adding them in the
+        # order they were set rebuilds the scores each user could be promoted to
+        snapshot_scores = sorted(self.scores, key=attrgetter('score_time'))
+        self.window_scores = {}
+        for s in chain(snapshot_scores, journal_scores):
+            self._add_window_score(s)
+
+        self.scores = []
+        self.score_keys = []
+        self.user_scores = {}
+        self.aggregate_score = 0
+        for candidates in self.window_scores.itervalues():
+            self._add_score(candidates[0])
+
+
+    # returns the scores to journal for the new scores, which must be journaled before they are set
+    def _get_journal_scores(self, user, new_scores, score_time):
+        username = user.username
+        if self.window:
+            # every score set in the window is kept until it expires
+            return [UserScore(username, new_score, score_time) for new_score in new_scores]
+
+        # only the user's new best score needs to be journaled
+        best_score = None
+        users_score = self.user_scores.get(username)
+        if users_score is not None:
+            best_score = users_score.score
+        new_best_score = None
+        for new_score in new_scores:
+            if best_score is None or self._is_better(new_score, best_score):
+                best_score = new_best_score = new_score
+        if new_best_score is None:
+            return []
+        return [UserScore(username, new_best_score, score_time)]
+
+
+    def _append_journal(self, user_scores):
+        if not user_scores:
+            return
+
+        records = ''.join(['%s %r %r\n' % (_encode_username(s.user), s.score, s.score_time) for s in user_scores])
+        try:
+            f = open(unicode(self.journal_path), 'a')
+            try:
+                f.write(records)
+                f.flush()
+                fsync(f.fileno())
+            finally:
+                f.close()
+        except (IOError, OSError) as e:
+            LOG.error('Failed writing leaderboard journal "%s": %s', self.journal_path, str(e))
+            # remove any records that were written so that scores reported as failed are not loaded later
+            try:
+                f = open(unicode(self.journal_path), 'r+')
+                try:
+                    f.truncate(self.files.journal_size)
+                finally:
+                    f.close()
+            except IOError:
+                pass
+            raise LeaderboardError('Failed writing leaderboard journal %s' % self.journal_path)
+
+        self.files.journal_size += len(records)
+
+
+    # must be called after the journaled scores are set so that the snapshot includes them
+    def _check_compaction(self):
+        files = self.files
+        if files.journal_size > self.journal_compact_size and not files.compacting:
+            self._start_compaction()
 
 
-    def _write_leaderboard(self):
-        self._sort_scores()
+    def _start_compaction(self):
+        self.files.compacting = True
+        if self.window:
+            # every score that could be promoted is kept so that it can still be promoted after a reload
+            get_score_key = self._get_score_key
+            scores = [s.copy() for candidates in self.window_scores.itervalues() for s in candidates]
+            scores.sort(key=lambda s: get_score_key(s.score, s.score_time))
+        else:
+            # copy the scores as they are updated in place by later calls to set
+            scores = [s.copy() for s in self.scores]
+        thread = Thread(target=self._compact_journal,
+                        args=[scores, self.files.journal_size, self.files.generation])
+        thread.daemon = True
+        thread.start()
+
+
+    def _compact_journal(self, scores, journal_offset, generation):
+        # runs in its own thread so any error must be logged here and compacting always reset
+        tmp_path = self.path + '.tmp'
         try:
-            self._set_path()
+            self._write_leaderboard(tmp_path, scores)
+            with self.lock:
+                # the journal offset is only valid for the files of the generation it was taken from
+                if generation == self.files.generation:
+                    self._replace_snapshot(tmp_path, journal_offset)
+        except LeaderboardError:
+            pass
+        # pylint: disable=W0703
+        except Exception as e:
+            LOG.exception('Failed compacting leaderboard journal "%s": %s', self.journal_path, str(e))
+        # pylint: enable=W0703
+        finally:
             with self.lock:
+                self.files.compacting = False
+            # left behind if the snapshot failed or the leaderboard was emptied while it was being written
+            unicode_tmp_path = unicode(tmp_path)
+            if path_exists(unicode_tmp_path):
+                try:
+                    remove_file(unicode_tmp_path)
+                except OSError:
+                    pass
+
+
+    # must be called with the lock held
+    def _replace_snapshot(self, tmp_path, journal_offset):
+        try:
+            replace_file(tmp_path, self.path)
+
+            # keep only the records appended while the snapshot was being written
+            unicode_path = unicode(self.journal_path)
+            f = open(unicode_path, 'r')
+            try:
+                f.seek(journal_offset)
+                records = f.read()
+            finally:
+                f.close()
+
+            journal_tmp_path = self.journal_path + '.tmp'
+            try:
+                f = open(unicode(journal_tmp_path), 'w')
                 try:
-                    f = open(unicode(self.path), 'w')
-                    yaml.dump([s.to_dict() for s in self.scores], f, default_flow_style=False)
+                    f.write(records)
+                    f.flush()
+                    fsync(f.fileno())
                 finally:
                     f.close()
-        except IOError as e:
-            LOG.error('Failed writing leaderboard file "%s": %s', self.path, str(e))
-            raise LeaderboardError('Failed writing leaderboard file %s' % self.path)
+                replace_file(journal_tmp_path, unicode_path)
+            except (IOError, OSError):
+                try:
+                    remove_file(unicode(journal_tmp_path))
+                except OSError:
+                    pass
+                raise
+            self.files.journal_size = len(records)
+
+        except (IOError, OSError) as e:
+            # the journal is replayed over the snapshot so it is still consistent
+            LOG.error('Failed compacting leaderboard journal "%s": %s', self.journal_path, str(e))
+
+
+    def _write_leaderboard(self, path, scores):
+        try:
+            if self.format == 'binary':
+                f = open(unicode(path), 'wb')
+            else:
+                f = open(unicode(path), 'w')
+            try:
+                if self.format == 'binary':
+                    write_binary_scores(f, scores)
+                else:
+                    yaml.dump([s.to_dict() for s in scores], f, default_flow_style=False)
+                f.flush()
+                fsync(f.fileno())
+            finally:
+                f.close()
+        except (IOError, OSError) as e:
+            LOG.error('Failed writing leaderboard file "%s": %s', path, str(e))
+            raise LeaderboardError('Failed writing leaderboard file %s' % path)
 
 
     def _empty_leaderboard(self):
         self.scores = []
+        self.score_keys = []
         self.user_scores = {}
         self.aggregate_score = 0
+        self.expiry = []
+        self.window_scores = {}
+        self.next_expiry = float('inf')
+        # reload on the next request so that the default scores are restored
+        self.loaded = False
+        self.files.journal_size = 0
+        self.files.generation += 1
+        self._update_version()
+        self.overviews = {}
 
         self._set_path()
-        unicode_path = unicode(self.path)
-        if not path_exists(unicode_path):
-            return
+        unicode_path = unicode(self.journal_path)
+        if path_exists(unicode_path):
+            try:
+                remove_file(unicode_path)
+            except OSError as e:
+                LOG.error('Failed removing leaderboard journal "%s": %s', self.journal_path, str(e))
+                raise LeaderboardError('Failed emptying leaderboard file %s' % self.path)
+
+        # empty both formats so that an unconverted YAML file is not loaded in place of the binary file
+        for path in (self.yaml_path, self.binary_path):
+            unicode_path = unicode(path)
+            if not path_exists(unicode_path):
+                continue
 
-        with self.lock:
             try:
                 f = open(unicode_path, 'w')
                 f.close()
             except IOError as e:
-                LOG.error('Failed emptying leaderboard file "%s": %s', self.path, str(e))
-                raise LeaderboardError('Failed emptying leaderboard file %s' % self.path)
+                LOG.error('Failed emptying leaderboard file "%s": %s', path, str(e))
+                raise LeaderboardError('Failed emptying leaderboard file %s' % path)
 
 
     def _sort_scores(self):
         # sort best score first
-        self.scores.sort(key=lambda s: (-self.sort_by * s.score, s.score_time))
+        get_score_key = self._get_score_key
+        self.scores.sort(key=lambda s: get_score_key(s.score, s.score_time))
+        self.score_keys = [get_score_key(s.score, s.score_time) for s in self.scores]
 
 
     def _rank_leaderboard(self, leaderboard, top_rank):
@@ -291,13 +969,7 @@ class Leaderboard(object):
 
     @classmethod
     def _get_row(cls, username, score):
-        user = get_user(username)
-        return {'user':
-                    {
-                        'username': username,
-                        'displayName': username,
-                        'avatar': user.avatar
-                    },
+        return {'user': get_user_summary(username),
                 'score': score.score,
                 'time': score.score_time}
 
@@ -311,18 +983,32 @@ class Leaderboard(object):
 
 
     def _get_rank(self, score):
-        # the top rank of the score
-        top_rank = 1
-        # the num scores equal to the score
-        count = 0
-        for s in self.scores:
-            if score == s.score:
-                count += 1
-            else:
-                if count != 0:
-                    return (top_rank, count)
-                top_rank += 1
-        return (top_rank, count)
+        score_keys = self.score_keys
+        score_key = -self.sort_by * score
+        # the index of the first score equal to the score
+        top_index = bisect_left(score_keys, (score_key, ))
+        # the top rank of the score and the num scores equal to the score
+        return (top_index + 1, bisect_right(score_keys, (score_key, float('inf'))) - top_index)
+
+
+    def _get_rows(self, user, start, end):
+        leaderboard = []
+        player = None
+        for s in self.scores[start:end]:
+            username = s.user
+            row = self._get_row(username, s)
+            if username == user.username:
+                player = row
+
+            leaderboard.append(row)
+
+        if player is None:
+            player = self._get_user_row(user)
+
+        if len(leaderboard) > 0:
+            self._rank_leaderboard(leaderboard, self._get_rank(leaderboard[0]['score']))
+
+        return leaderboard, player
 
 
     @classmethod
@@ -339,189 +1025,200 @@ class Leaderboard(object):
 
 
     def get_top_players(self, user, num_top_players):
-        self._read_leaderboard()
-        scores = self.scores
-        leaderboard = []
-
-        player = None
-        try:
-            for i in xrange(num_top_players):
-                s = scores[i]
-                username = s.user
-                row = self._get_row(username, s)
-                if username == user.username:
-                    player = row
-
-                leaderboard.append(row)
-        except IndexError:
-            pass
+        with self.lock:
+            self._read_leaderboard()
+            return self._get_top_players(user, num_top_players)
 
-        if player is None:
-            player = self._get_user_row(user)
 
-        if len(leaderboard) > 0:
-            self._rank_leaderboard(leaderboard, self._get_rank(leaderboard[0]['score']))
+    def _get_top_players(self, user, num_top_players):
+        leaderboard, player = self._get_rows(user, 0, num_top_players)
 
-        bottom = len(scores) <= num_top_players
+        bottom = len(self.scores) <= num_top_players
         return self.create_response(True, bottom, leaderboard, player)
 
 
     def get_page(self, user, max_page_size, is_above, score, score_time):
-        self._read_leaderboard()
-        scores = self.scores
-        leaderboard = []
-
-        player = None
-        query_complete = False
+        with self.lock:
+            self._read_leaderboard()
 
-        if not is_above:
-            scores = reversed(scores)
-        for s in scores:
+            num_scores = len(self.scores)
+            score_key = self._get_score_key(score, score_time)
+            # pages near the edges of the board are filled up to the page size
+            min_page_size = min(max_page_size, num_scores)
             if is_above:
-                if self.sort_by * s.score < self.sort_by * score or (s.score == score and s.score_time >= score_time):
-                    query_complete = True
+                # the page ends at the first score that is not above the given score
+                end = max(bisect_left(self.score_keys, score_key), min_page_size)
+                start = max(end - max_page_size, 0)
             else:
-                if self.sort_by * s.score > self.sort_by * score or (s.score == score and s.score_time <= score_time):
-                    query_complete = True
+                # the page starts after the last score that is not below the given score
+                start = min(bisect_right(self.score_keys, score_key), num_scores - min_page_size)
+                end = min(start + max_page_size, num_scores)
 
-            if query_complete and len(leaderboard) >= max_page_size:
-                break
+            leaderboard, player = self._get_rows(user, start, end)
 
-            username = s.user
-            row = self._get_row(username, s)
-            if username == user.username:
-                player = row
+            top = (start == 0)
+            bottom = (end == num_scores)
+            return self.create_response(top, bottom, leaderboard, player)
 
-            leaderboard.append(row)
 
-        # throw away scores after the end of the page
-        leaderboard = leaderboard[-max_page_size:]
+    def get_near(self, user, size):
+        with self.lock:
+            self._read_leaderboard()
 
-        # flip the scores back in the right direction for below queries
-        if not is_above:
-            leaderboard = list(reversed(leaderboard))
+            scores = self.scores
+            if len(scores) == 0:
+                return self.create_response(True, True, [])
 
-        if player is None:
-            player = self._get_user_row(user)
+            try:
+                index = self._get_user_index(user.username)
+            except KeyError:
+                return self._get_top_players(user, size)
 
-        if len(leaderboard) > 0:
-            self._rank_leaderboard(leaderboard, self._get_rank(leaderboard[0]['score']))
-            top = (self.scores[0].user == leaderboard[0]['user']['username'])
-            bottom = (self.scores[-1].user == leaderboard[-1]['user']['username'])
-        else:
-            top = True
-            bottom = True
+            # higher board is larger for even numbers
+            start = index - int(floor(size * 0.5))
+            end = index + int(ceil(size * 0.5))
 
-        return self.create_response(top, bottom, leaderboard, player)
+            # slide start and end when the player is on the edge of a board
+            num_scores = len(scores)
+            if start < 0:
+                end -= start
+                start = 0
+                if end > num_scores:
+                    end = num_scores
+            elif end > num_scores:
+                start -= (end - num_scores)
+                end = num_scores
+                if start < 0:
+                    start = 0
 
+            leaderboard, player = self._get_rows(user, start, end)
 
-    def get_near(self, user, size):
-        self._read_leaderboard()
+            top = (start == 0)
+            bottom = (end == num_scores)
+            return self.create_response(top, bottom, leaderboard, player)
 
-        scores = self.scores
-        if len(scores) == 0:
-            return self.create_response(True, True, [])
 
-        if not user.username in self.user_scores:
-            return self.get_top_players(user, size)
+    def read_overview(self, user):
+        username = user.username
+        # cached overviews are only removed with the lock held so they can be read without it, a read that
+        # races a score change returns the overview from before the change
+        overviews = self.overviews
+        if time_now() < self.next_expiry:
+            try:
+                return overviews[username]
+            except KeyError:
+                pass
 
-        index = None
+        with self.lock:
+            self._read_leaderboard()
+            try:
+                users_score = self.user_scores[username]
+                overview = {'key': self.key,
+                            'score': users_score.score,
+                            'rank': self._get_user_rank(username),
+                            'time': users_score.score_time}
+            except KeyError:
+                overview = None
+            self.overviews[username] = overview
+            return overview
 
-        for i, r in enumerate(scores):
-            if r.user == user.username:
-                index = i
-                break
 
-        # higher board is larger for even numbers
-        start = index - int(floor(size * 0.5))
-        end = index + int(ceil(size * 0.5))
+    def read_aggregates(self):
+        with self.lock:
+            self._read_leaderboard()
+            if self.aggregate:
+                return {
+                    'key': self.key,
+                    'aggregateScore': self.aggregate_score,
+                    'numUsers': len(self.scores)
+                }
+            return None
 
-        # slide start and end when the player is on the edge of a board
-        num_scores = len(scores)
-        if start < 0:
-            end -= start
-            start = 0
-            if end > num_scores:
-                end = num_scores
-        elif end > num_scores:
-            start -= (end - num_scores)
-            end = num_scores
-            if start < 0:
-                start = 0
 
-        leaderboard = []
-        player = None
-        for i in xrange(start, end, 1):
-            s = scores[i]
-            username = s.user
-            row = self._get_row(username, s)
-            if username == user.username:
-                player = row
+    def _set(self, user, new_score, score_time):
+        if self.window:
+            return self._set_window_score(user, new_score, score_time)
 
-            leaderboard.append(row)
+        try:
+            users_score = self.user_scores[user.username]
+        except KeyError:
+            # User has no score on the leaderboard
+            users_score = UserScore(user.username, new_score, score_time)
+            self._insert_score(users_score)
+            self._update_version()
+            self._invalidate_overviews(user.username, None, new_score)
+            return {'newBest': True}
 
-        if player is None:
-            player = self._get_user_row(user)
+        old_score = users_score.score
 
-        self._rank_leaderboard(leaderboard, self._get_rank(leaderboard[0]['score']))
+        if (self.sort_by == 1 and old_score >= new_score) or (self.sort_by == -1 and old_score <= new_score):
+            return {'bestScore': old_score}
 
-        top = (start == 0)
-        bottom = (end == num_scores)
-        return self.create_response(top, bottom, leaderboard, player)
+        # the score must be moved to its new position on the board
+        self._remove_score(users_score)
+        users_score.score = new_score
+        users_score.score_time = score_time
+        self._insert_score(users_score)
+        self._update_version()
+        self._invalidate_overviews(user.username, old_score, new_score)
 
+        return {'newBest': True, 'prevBest': old_score}
 
-    def read_overview(self, user):
-        self._read_leaderboard()
-        try:
-            users_score = self.user_scores[user.username]
-            score = users_score.score
-            rank = self._get_rank(score)[0]
-            return {'key': self.key,
-                    'score': score,
-                    'rank': rank,
-                    'time': users_score.score_time}
-        except KeyError:
-            return None
 
+    def _set_window_score(self, user, new_score, score_time):
+        users_score = UserScore(user.username, new_score, score_time)
+        (is_best, best_score) = self._add_window_score(users_score)
+        self._add_expiry(users_score)
+        if not is_best:
+            return {'bestScore': best_score.score}
 
-    def read_aggregates(self):
-        self._read_leaderboard()
-        if self.aggregate:
-            return {
-                'key': self.key,
-                'aggregateScore': self.aggregate_score,
-                'numUsers': len(self.scores)
-            }
-        return None
+        if best_score is not None:
+            self._remove_score(best_score)
+        self._insert_score(users_score)
+        self._update_version()
+
+        if best_score is None:
+            self._invalidate_overviews(user.username, None, new_score)
+            return {'newBest': True}
+        self._invalidate_overviews(user.username, best_score.score, new_score)
+        return {'newBest': True, 'prevBest': best_score.score}
 
 
     def set(self, user, new_score):
         score_time = time_now()
 
-        self._read_leaderboard()
-        try:
-            users_score = self.user_scores[user.username]
-            old_score = users_score.score
+        with self.lock:
+            self._read_leaderboard()
+            # nothing is changed if the score cannot be journaled
+            self._append_journal(self._get_journal_scores(user, [new_score], score_time))
+            result = self._set(user, new_score, score_time)
+            self._check_compaction()
+            return result
 
-            if (self.sort_by == 1 and old_score >= new_score) or (self.sort_by == -1 and old_score <= new_score):
-                return {'bestScore': old_score}
 
-            users_score.score = new_score
-            users_score.score_time = score_time
+    def set_scores(self, user, new_scores):
+        score_time = time_now()
 
-            if self.aggregate:
-                self.aggregate_score += new_score - old_score
-            self._write_leaderboard()
-            return {'newBest': True, 'prevBest': old_score}
-        except KeyError:
-            # User has no score on the leaderboard
-            self._add_score(UserScore(user.username, new_score, score_time))
-            self._write_leaderboard()
-            return {'newBest': True}
+        with self.lock:
+            self._read_leaderboard()
+            # nothing is changed if the scores cannot be journaled
+            self._append_journal(self._get_journal_scores(user, new_scores, score_time))
+            results = [self._set(user, new_score, score_time) for new_score in new_scores]
+            self._check_compaction()
+            return results
 
 
     def remove(self):
-        self._empty_leaderboard()
+        with self.lock:
+            self._empty_leaderboard()
+
+
+    def get_version(self):
+        # expire any old scores first so that responses cached for the version are not reused
+        if time_now() >= self.next_expiry:
+            with self.lock:
+                self._expire_scores()
+        return self.version
 
 
 class GameLeaderboards(object):
@@ -594,6 +1291,10 @@ class GameLeaderboards(object):
     def read_aggregates(self):
         return [l.read_aggregates() for l in self.ordered_leaderboards if l.aggregate]
 
+    def get_version(self, key):
+        return self._get_leaderboard(key).get_version()
+
+
     def get_top_players(self, key, user, num_top_players):
         return self._get_leaderboard(key).get_top_players(user, num_top_players)
 
@@ -610,6 +1311,30 @@ class GameLeaderboards(object):
         return self._get_leaderboard(key).set(user, score)
 
 
+    def set_batch(self, user, key_scores):
+        # check all of the keys before any scores are set
+        leaderboards = []
+        scores_by_key = {}
+        for (key, score) in key_scores:
+            if key not in scores_by_key:
+                leaderboards.append(self._get_leaderboard(key))
+                scores_by_key[key] = []
+            scores_by_key[key].append(score)
+
+        results_by_key = {}
+        for leaderboard in leaderboards:
+            key = leaderboard.key
+            results_by_key[key] = leaderboard.set_scores(user, scores_by_key[key])
+
+        # return the results in the order that the scores were given
+        results = []
+        for (key, _) in key_scores:
+            result = results_by_key[key].pop(0)
+            result['key'] = key
+            results.append(result)
+        return results
+
+
     def remove_all(self):
         for key in self.leaderboards:
             self.leaderboards[key].remove()
@@ -2,17 +2,54 @@
 
 import logging
 import os
+from itertools import count
+from re import compile as regex_compile
+from struct import Struct, error as StructError
+from threading import Lock
+from time import time as time_now
+from zlib import crc32, compressobj, decompress, DEFLATED, MAX_WBITS, error as ZlibError
+
+from simplejson import load as json_load, dump as json_dump, dumps as json_dumps, loads as json_loads
 
 # pylint: disable=F0401
 from pylons import config
+from paste.deploy.converters import asint
 # pylint: enable=F0401
 
-from os.path import join as join_path
+from os.path import join as join_path, exists as path_exists
 
-from turbulenz_local.tools import get_absolute_path, create_dir
+from turbulenz_local.tools import get_absolute_path, create_dir, replace_file, sync_dir
+from turbulenz_local.lib.groupcommit import GroupCommit
+from turbulenz_local.lib.lrucache import LRUCache
 
 LOG = logging.getLogger(__name__)
 
+USERDATA_FORMATS = ['files', 'packed']
+
+# the sizes and modification times of the keys are kept in this file in each user's folder with the changes
+# since it was written appended to the journal
+KEY_INDEX_FILENAME = '.keyindex.json'
+KEY_INDEX_JOURNAL_FILENAME = '.keyindex.journal'
+
+# packed userdata files are a header followed by groups of records, each record is a crc32 of the rest of
+# the record, the record header and then the key and the value
+PACK_FILENAME = 'userdata.pack'
+PACK_MAGIC = 'TZUD'
+PACK_VERSION = 1
+PACK_HEADER = Struct('<4sI')
+PACK_CRC = Struct('<I')
+PACK_RECORD = Struct('<BdHI')
+PACK_SET = 1
+PACK_REMOVE = 2
+# set on the set records of values that are JSON
+PACK_JSON = 0x40
+# set on the last record of each group, groups without it were only partly written and are ignored
+PACK_END = 0x80
+
+# large values are stored gzip compressed, values are UTF-8 so they can never start with the gzip magic
+GZIP_MAGIC = '\x1f\x8b'
+GZIP_WBITS = MAX_WBITS | 16
+
 
 class UserDataPathError(Exception):
     pass
@@ -26,75 +63,326 @@ class UserDataKeyError(Exception):
     pass
 
 
-class UserData(object):
+def read_userdata_files(path):
+    """ Returns the (key, value, mtime, is JSON) of each <key>.txt file in the folder """
+    items = []
+    for key_file in os.listdir(path):
+        (key, ext) = os.path.splitext(key_file)
+        if ext == '.txt':
+            key_path = unicode(join_path(path, key_file))
+            f = open(key_path, 'rb')
+            try:
+                value = f.read()
+                items.append((key, value, os.fstat(f.fileno()).st_mtime, is_json_value(value)))
+            finally:
+                f.close()
+    return items
 
-    def __init__(self, session=None, game=None, user=None):
-        if session is None:
-            self.game = game
-            self.user = user
-        else:
-            self.game = session.game
-            self.user = session.user
 
+def remove_userdata_files(path):
+    """ Removes the <key>.txt files and key index of the files format from the folder """
+    for key_file in os.listdir(path):
+        if os.path.splitext(key_file)[1] == '.txt' or key_file in (KEY_INDEX_FILENAME, KEY_INDEX_JOURNAL_FILENAME):
+            os.remove(unicode(join_path(path, key_file)))
+
+
+def write_userdata_pack(f, items):
+    """ Writes the (key, value, mtime, is JSON) items as a new pack and returns the index of the values """
+    index = {}
+    offset = PACK_HEADER.size
+    chunks = [PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION)]
+    num_items = len(items)
+    for (i, (key, value, mtime, is_json)) in enumerate(items):
+        op = PACK_SET
+        if is_json:
+            op |= PACK_JSON
+        if i == num_items - 1:
+            op |= PACK_END
+        record = PACK_RECORD.pack(op, mtime, len(key), len(value)) + key + value
+        chunks.append(PACK_CRC.pack(crc32(record) & 0xffffffff))
+        chunks.append(record)
+        offset += PACK_CRC.size + PACK_RECORD.size + len(key)
+        index[key] = (offset, len(value), mtime, is_json)
+        offset += len(value)
+    f.write(''.join(chunks))
+    return index
+
+
+def _encode_value(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _remove_tmp(tmp_path):
+    try:
+        os.remove(unicode(tmp_path))
+    except OSError:
+        pass
+
+
+def compress_value(value, compress_level):
+    compressor = compressobj(compress_level, DEFLATED, GZIP_WBITS)
+    return compressor.compress(value) + compressor.flush()
+
+
+def decompress_value(data):
+    return decompress(data, GZIP_WBITS)
+
+
+def is_compressed(data):
+    return data[:2] == GZIP_MAGIC
+
+
+def is_json_value(data):
+    """ Checks if the stored value is JSON, values are checked once when they are written and the result is
+        kept with their size and modification time
+    """
+    try:
+        if is_compressed(data):
+            data = decompress_value(data)
+        json_loads(data)
+    except (ValueError, ZlibError):
+        return False
+    return True
+
+
+class UserDataFiles(object):
+    """ Stores each key in a <key>.txt file in the user's folder, values are written to a temporary file that
+        is renamed over the key's file so a key always has either its old or its new value
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        # key -> (size, mtime, is JSON) of the files, read or built on first use
+        self.key_index = None
+        # changes to the key index are appended to its journal until it is this big
+        self.key_index_journal_size = 0
+        self.key_index_compact_size = asint(config.get('userdata.key_index_compact_size', 65536))
+        # the renames of concurrent writes are made durable by a single sync of the folder
+        self.commits = GroupCommit(self._sync)
+        self.tmp_ids = count()
+
+
+    def _sync(self):
+        sync_dir(unicode(self.path))
+
+
+    def _commit(self):
         try:
-            path = config['userdata_db']
-        except KeyError:
-            LOG.error('userdata_db path config variable not set')
-            return
+            self.commits.commit()
+        except OSError, e:
+            LOG.error('Failed syncing userdata: %s', str(e))
+            raise UserDataError
 
-        # Create userdata folder and user folder on the game path
-        path = join_path(path, self.game.slug, self.user.username)
-        if not create_dir(path):
-            raise UserDataPathError('User UserData path \"%s\" could not be created.' % path)
-        self.path = get_absolute_path(path)
+
+    # returns the path of a new temporary file with the value and the (size, mtime, is JSON) of the value
+    def _write_tmp(self, key, value):
+        # concurrent writes of the same key each need their own temporary file
+        tmp_path = join_path(self.path, '%s.%d.tmp' % (key, next(self.tmp_ids)))
+        value = _encode_value(value)
+        f = open(unicode(tmp_path), 'wb')
+        try:
+            try:
+                f.write(value)
+                f.flush()
+                os.fsync(f.fileno())
+                stat = os.fstat(f.fileno())
+            finally:
+                f.close()
+        except (IOError, OSError):
+            _remove_tmp(tmp_path)
+            raise
+        return tmp_path, (stat.st_size, stat.st_mtime, is_json_value(value))
 
 
-    def get_keys(self):
-        key_files = os.listdir(self.path)
-        list_array = []
+    @classmethod
+    def _get_key_file_info(cls, key_path):
+        f = open(unicode(key_path), 'rb')
+        try:
+            stat = os.fstat(f.fileno())
+            return (stat.st_size, stat.st_mtime, is_json_value(f.read()))
+        finally:
+            f.close()
+
+
+    @classmethod
+    def _parse_key_info(cls, key_info):
+        (size, mtime, is_json) = key_info
+        return (int(size), float(mtime), bool(is_json))
 
+
+    @classmethod
+    def _apply_key_index_record(cls, key_index, record):
+        if record.get('clear'):
+            key_index.clear()
+        for key in record.get('remove', ()):
+            key_index.pop(key, None)
+        parse_key_info = cls._parse_key_info
+        for (key, key_info) in record.get('set', {}).iteritems():
+            key_index[key] = parse_key_info(key_info)
+
+
+    def _read_key_index(self):
+        index_path = join_path(self.path, KEY_INDEX_FILENAME)
+        journal_path = join_path(self.path, KEY_INDEX_JOURNAL_FILENAME)
+        try:
+            index_mtime = os.stat(unicode(index_path)).st_mtime
+            try:
+                journal_mtime = os.stat(unicode(journal_path)).st_mtime
+            except OSError:
+                journal_mtime = None
+            # keys added or removed by anything else change the folder after the index was last written
+            if max(index_mtime, journal_mtime) < os.stat(unicode(self.path)).st_mtime:
+                return None
+
+            f = open(unicode(index_path), 'r')
+            try:
+                file_index = json_load(f)
+            finally:
+                f.close()
+            parse_key_info = self._parse_key_info
+            key_index = dict((key, parse_key_info(key_info)) for (key, key_info) in file_index.iteritems())
+
+            journal = ''
+            if journal_mtime is not None:
+                f = open(unicode(journal_path), 'rb')
+                try:
+                    journal = f.read()
+                finally:
+                    f.close()
+                # a change that was not completely appended leaves the index unknown so it is rebuilt
+                if journal and not journal.endswith('\n'):
+                    return None
+                for line in journal.splitlines():
+                    self._apply_key_index_record(key_index, json_loads(line))
+
+            self.key_index_journal_size = len(journal)
+            return key_index
+        except (IOError, OSError, ValueError, TypeError, AttributeError):
+            return None
+
+
+    def _build_key_index(self):
+        try:
+            key_files = os.listdir(self.path)
+        except OSError, e:
+            LOG.error('Failed listing userdata: %s', str(e))
+            raise UserDataError
+
+        key_index = {}
         for key_file in key_files:
+            (key, ext) = os.path.splitext(key_file)
+            if ext == '.txt':
+                try:
+                    key_index[key] = self._get_key_file_info(join_path(self.path, key_file))
+                except (IOError, OSError):
+                    # removed since the folder was listed
+                    continue
+        return key_index
+
+
+    def _remove_key_index(self):
+        # the index is rebuilt from the folder when it cannot be read so this only costs a rebuild
+        for filename in (KEY_INDEX_FILENAME, KEY_INDEX_JOURNAL_FILENAME):
             try:
-                f = open(unicode(join_path(self.path, key_file)), 'r')
-                (key, ext) = os.path.splitext(key_file)
-                if ext == '.txt':
-                    try:
-                        list_array.append(key)
-                    finally:
-                        f.close()
-            except IOError, e:
-                LOG.error('Failed listing userdata: %s', str(e))
-                raise UserDataError
+                os.remove(unicode(join_path(self.path, filename)))
+            except OSError:
+                pass
+
+
+    # must be called with the lock held
+    def _write_key_index(self, key_index):
+        index_path = join_path(self.path, KEY_INDEX_FILENAME)
+        tmp_path = index_path + '.tmp'
+        try:
+            f = open(unicode(tmp_path), 'w')
+            try:
+                json_dump(key_index, f, separators=(',', ':'))
+            finally:
+                f.close()
+            replace_file(unicode(tmp_path), unicode(index_path))
+            # the changes in the journal are all in the new index
+            journal_path = join_path(self.path, KEY_INDEX_JOURNAL_FILENAME)
+            if path_exists(unicode(journal_path)):
+                os.remove(unicode(journal_path))
+            # the rename changes the folder so mark the index as newer than the folder
+            os.utime(unicode(index_path), None)
+            self.key_index_journal_size = 0
+        except (IOError, OSError), e:
+            LOG.error('Failed writing userdata key index: %s', str(e))
+            _remove_tmp(tmp_path)
+            self._remove_key_index()
+
+
+    # must be called with the lock held
+    def _append_key_index(self, record):
+        line = json_dumps(record, separators=(',', ':')) + '\n'
+        if self.key_index_journal_size + len(line) > self.key_index_compact_size:
+            self._write_key_index(self.key_index)
+            return
+
+        try:
+            # appending a line changes the journal after the folder so the index is still newer than it
+            f = open(unicode(join_path(self.path, KEY_INDEX_JOURNAL_FILENAME)), 'ab')
+            try:
+                f.write(line)
+            finally:
+                f.close()
+            self.key_index_journal_size += len(line)
+        except (IOError, OSError), e:
+            LOG.error('Failed writing userdata key index: %s', str(e))
+            self._remove_key_index()
+
+
+    # must be called with the lock held
+    def _get_key_index(self):
+        key_index = self.key_index
+        if key_index is None:
+            key_index = self._read_key_index()
+            if key_index is None:
+                key_index = self._build_key_index()
+                self._write_key_index(key_index)
+            self.key_index = key_index
+        return key_index
+
+
+    def _update_key_index(self, set_keys=None, removed_keys=None, remove_all=False):
+        # only the change is appended to the journal, the whole index is written once the journal is big
+        record = {}
+        if remove_all:
+            record['clear'] = True
+        if removed_keys:
+            record['remove'] = list(removed_keys)
+        if set_keys:
+            record['set'] = set_keys
+        with self.lock:
+            key_index = self._get_key_index()
+            self._apply_key_index_record(key_index, record)
+            self._append_key_index(record)
+
+
+    def get_keys(self):
+        with self.lock:
+            return self._get_key_index().keys()
 
-        # keys and values
-        #for key_file in key_files:
-        #    try:
-        #        f = open(unicode(join_path(self.path, key_file)), 'r')
-        #        (key, ext) = os.path.splitext(key_file)
-        #        if (ext == '.txt'):
-        #            try:
-        #                list_array.append({
-        #                    'key': key,
-        #                    'value': f.read()
-        #                    })
-        #            finally:
-        #                f.close()
-        #    except IOError, e:
-        #        LOG.error('Failed listing userdata: %s', str(e))
-        #        raise UserDataError
-
-        return list_array
+
+    def get_key_info(self):
+        with self.lock:
+            return dict((key, {'size': size, 'modified': mtime, 'json': is_json})
+                        for (key, (size, mtime, is_json)) in self._get_key_index().iteritems())
 
 
     def exists(self, key):
-        key_path = join_path(self.path, key + '.txt')
-        return os.path.exists(key_path)
+        with self.lock:
+            return key in self._get_key_index()
 
 
     def get(self, key):
         key_path = join_path(self.path, key + '.txt')
         try:
-            f = open(unicode(key_path), 'r')
+            f = open(unicode(key_path), 'rb')
             try:
                 value = f.read()
             finally:
@@ -105,17 +393,19 @@ class UserData(object):
 
 
     def set(self, key, value):
-        key_path = join_path(self.path, key + '.txt')
         try:
-            f = open(unicode(key_path), 'w')
+            (tmp_path, key_info) = self._write_tmp(key, value)
             try:
-                f.write(value)
-            finally:
-                f.close()
-        except IOError, e:
+                replace_file(unicode(tmp_path), unicode(join_path(self.path, key + '.txt')))
+            except OSError:
+                _remove_tmp(tmp_path)
+                raise
+        except (IOError, OSError), e:
             LOG.error('Failed setting userdata: %s', str(e))
             raise UserDataError
         else:
+            self._update_key_index(set_keys={key: key_info})
+            self._commit()
             return True
 
 
@@ -126,23 +416,646 @@ class UserData(object):
                 os.remove(key_path)
             else:
                 raise UserDataKeyError
-        except IOError, e:
+        except (IOError, OSError), e:
             LOG.error('Failed removing userdata: %s', str(e))
             raise UserDataError
         else:
+            self._update_key_index(removed_keys=[key])
+            self._commit()
             return True
 
 
+    def get_many(self, keys):
+        # only the keys in the index are opened
+        with self.lock:
+            key_index = self._get_key_index()
+            existing_keys = [key for key in keys if key in key_index]
+
+        values = {}
+        for key in existing_keys:
+            if key not in values:
+                try:
+                    values[key] = self.get(key)
+                except UserDataKeyError:
+                    # removed since the index was read
+                    pass
+        return values
+
+
+    def _refresh_key_index(self, keys):
+        # after a failed batch the keys are indexed as they are on disk, whether or not they were restored
+        set_keys = {}
+        removed_keys = []
+        for key in keys:
+            try:
+                set_keys[key] = self._get_key_file_info(join_path(self.path, key + '.txt'))
+            except (IOError, OSError):
+                removed_keys.append(key)
+        self._update_key_index(set_keys=set_keys, removed_keys=removed_keys)
+
+
+    @classmethod
+    def _backup_file(cls, key_path, backup_path):
+        if hasattr(os, 'link'):
+            # a hard link keeps the key readable until the new value is renamed over it
+            os.link(unicode(key_path), unicode(backup_path))
+        else:
+            # Windows cannot rename over a file so the key is briefly missing while it is replaced anyway
+            os.rename(unicode(key_path), unicode(backup_path))
+
+
+    @classmethod
+    def _restore_files(cls, replaced):
+        for (key_path, backup_path) in reversed(replaced):
+            try:
+                if backup_path is None:
+                    if path_exists(unicode(key_path)):
+                        os.remove(unicode(key_path))
+                else:
+                    replace_file(unicode(backup_path), unicode(key_path))
+                    # renaming a hard link over the file it links to does nothing so the link can be left
+                    _remove_tmp(backup_path)
+            except OSError, e:
+                LOG.error('Failed restoring userdata "%s": %s', key_path, str(e))
+
+
+    def set_many(self, key_values):
+        # write every value to a temporary file first so that nothing is changed if any of the writes fail
+        tmp_paths = []
+        set_keys = {}
+        try:
+            for (key, value) in key_values.iteritems():
+                (tmp_path, key_info) = self._write_tmp(key, value)
+                tmp_paths.append((tmp_path, join_path(self.path, key + '.txt')))
+                set_keys[key] = key_info
+        except (IOError, OSError), e:
+            LOG.error('Failed setting userdata: %s', str(e))
+            for (tmp_path, _) in tmp_paths:
+                _remove_tmp(tmp_path)
+            raise UserDataError
+
+        # the replaced files are kept until every key is renamed so that they can be restored if a rename fails
+        replaced = []
+        try:
+            for (tmp_path, key_path) in tmp_paths:
+                backup_path = None
+                if path_exists(unicode(key_path)):
+                    backup_path = tmp_path[:-len('.tmp')] + '.bak'
+                    self._backup_file(key_path, backup_path)
+                replaced.append((key_path, backup_path))
+                replace_file(unicode(tmp_path), unicode(key_path))
+
+        except OSError, e:
+            LOG.error('Failed setting userdata: %s', str(e))
+            self._restore_files(replaced)
+            for (tmp_path, _) in tmp_paths:
+                _remove_tmp(tmp_path)
+            self._refresh_key_index(set_keys.iterkeys())
+            self._commit()
+            raise UserDataError
+
+        for (_, backup_path) in replaced:
+            if backup_path is not None:
+                _remove_tmp(backup_path)
+        self._update_key_index(set_keys=set_keys)
+        # all of the renames are made durable together
+        self._commit()
+        return True
+
+
+    def remove_many(self, keys):
+        # check all of the keys exist before any are removed
+        with self.lock:
+            key_index = self._get_key_index()
+            for key in keys:
+                if key not in key_index:
+                    raise UserDataKeyError
+
+        # the keys are renamed to tombstones and only deleted once they are all renamed so that they can be
+        # renamed back if any of the renames fail
+        removed = []
+        try:
+            for key in set(keys):
+                key_path = join_path(self.path, key + '.txt')
+                tombstone_path = join_path(self.path, '%s.%d.del' % (key, next(self.tmp_ids)))
+                os.rename(unicode(key_path), unicode(tombstone_path))
+                removed.append((key_path, tombstone_path))
+
+        except OSError, e:
+            LOG.error('Failed removing userdata: %s', str(e))
+            self._restore_files(removed)
+            self._refresh_key_index(set(keys))
+            self._commit()
+            raise UserDataError
+
+        for (_, tombstone_path) in removed:
+            _remove_tmp(tombstone_path)
+        self._update_key_index(removed_keys=set(keys))
+        self._commit()
+        return True
+
+
     def remove_all(self):
         key_paths = os.listdir(self.path)
 
+        removed_keys = []
         for key_path in key_paths:
-            (_, ext) = os.path.splitext(key_path)
+            (key, ext) = os.path.splitext(key_path)
             if ext == '.txt':
                 try:
                     os.remove(unicode(join_path(self.path, key_path)))
-                except IOError, e:
+                    removed_keys.append(key)
+                except (IOError, OSError), e:
                     LOG.error('Failed removing userdata: %s', str(e))
+                    self._update_key_index(removed_keys=removed_keys)
                     raise UserDataError
 
+        self._update_key_index(remove_all=True)
+        self._commit()
+        return True
+
+
+class UserDataPack(object):
+    """ Stores all of the user's keys in a single append only pack file that is compacted once most of it
+        is replaced values
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pack_path = join_path(path, PACK_FILENAME)
+        self.lock = Lock()
+        # key -> (value offset, value length, mtime, is JSON), read on first use
+        self.index = None
+        # the end of the last complete group of records
+        self.size = 0
+        # the size of the records of the values in the index, the rest of the pack can be compacted away
+        self.live_size = 0
+        self.compact_size = asint(config.get('userdata.pack_compact_size', 65536))
+        # the groups appended by concurrent writes are made durable by a single sync of the pack
+        self.commits = GroupCommit(self._sync)
+
+
+    def _sync(self):
+        # opened for appending as Windows can only sync files that are open for writing
+        f = open(unicode(self.pack_path), 'ab')
+        try:
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+
+
+    def _commit(self):
+        try:
+            self.commits.commit()
+        except (IOError, OSError), e:
+            LOG.error('Failed syncing userdata pack "%s": %s', self.pack_path, str(e))
+            raise UserDataError
+
+
+    @classmethod
+    def _get_record_size(cls, key, value_length):
+        return PACK_CRC.size + PACK_RECORD.size + len(key) + value_length
+
+
+    def _set_index(self, index, size):
+        self.index = index
+        self.size = size
+        get_record_size = self._get_record_size
+        self.live_size = sum(get_record_size(key, value_length) for (key, (_, value_length, _, _)) in index.iteritems())
+
+
+    def _read_pack(self):
+        f = open(unicode(self.pack_path), 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+
+        (magic, version) = PACK_HEADER.unpack_from(data, 0)
+        if magic != PACK_MAGIC or version != PACK_VERSION:
+            raise ValueError('Not a version %d userdata pack' % PACK_VERSION)
+
+        index = {}
+        group = []
+        length = len(data)
+        offset = end = PACK_HEADER.size
+        record_header_size = PACK_CRC.size + PACK_RECORD.size
+        while offset + record_header_size <= length:
+            (crc, ) = PACK_CRC.unpack_from(data, offset)
+            (op, mtime, key_length, value_length) = PACK_RECORD.unpack_from(data, offset + PACK_CRC.size)
+            key_offset = offset + record_header_size
+            value_offset = key_offset + key_length
+            next_offset = value_offset + value_length
+            if next_offset > length or crc32(data[offset + PACK_CRC.size:next_offset]) & 0xffffffff != crc:
+                # the server stopped while the last group was being appended
+                break
+
+            group.append((op & ~(PACK_END | PACK_JSON), data[key_offset:value_offset], value_offset, value_length,
+                          mtime, bool(op & PACK_JSON)))
+            offset = next_offset
+
+            if op & PACK_END:
+                for (record_op, key, value_offset, value_length, mtime, is_json) in group:
+                    if record_op == PACK_SET:
+                        index[key] = (value_offset, value_length, mtime, is_json)
+                    else:
+                        index.pop(key, None)
+                group = []
+                end = offset
+
+        if end < length:
+            LOG.warning('Ignoring incomplete records at the end of userdata pack "%s"', self.pack_path)
+            f = open(unicode(self.pack_path), 'r+b')
+            try:
+                f.truncate(end)
+            finally:
+                f.close()
+
+        return index, end
+
+
+    def _write_pack(self, items):
+        tmp_path = self.pack_path + '.tmp'
+        f = open(unicode(tmp_path), 'wb')
+        try:
+            index = write_userdata_pack(f, items)
+            size = f.tell()
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        replace_file(unicode(tmp_path), unicode(self.pack_path))
+        sync_dir(unicode(self.path))
+        self._set_index(index, size)
+
+
+    # the pack is kept indexed in memory once read so this must be called with the lock held
+    def _read_index(self):
+        if self.index is not None:
+            return self.index
+
+        moved = False
+        try:
+            if path_exists(unicode(self.pack_path)):
+                (index, size) = self._read_pack()
+                self._set_index(index, size)
+            else:
+                # keys stored by the files format are moved into a new pack when it is first used
+                self._write_pack(read_userdata_files(self.path))
+                moved = True
+        except (IOError, OSError, ValueError, StructError), e:
+            LOG.error('Failed reading userdata pack "%s": %s', self.pack_path, str(e))
+            raise UserDataError
+        else:
+            if moved:
+                # the key files are only removed once the pack is synced
+                try:
+                    remove_userdata_files(self.path)
+                except OSError, e:
+                    LOG.error('Failed removing userdata files moved into pack "%s": %s', self.pack_path, str(e))
+
+        return self.index
+
+
+    def _read_values(self, keys):
+        index = self._read_index()
+        values = {}
+        f = open(unicode(self.pack_path), 'rb')
+        try:
+            for key in keys:
+                (value_offset, value_length, _, _) = index[key]
+                f.seek(value_offset)
+                values[key] = f.read(value_length)
+        finally:
+            f.close()
+        return values
+
+
+    # must be called with the lock held
+    def _append_records(self, records):
+        index = self._read_index()
+
+        chunks = []
+        updates = []
+        offset = self.size
+        num_records = len(records)
+        for (i, (op, key, value)) in enumerate(records):
+            mtime = time_now()
+            is_json = (op == PACK_SET and is_json_value(value))
+            end_op = op
+            if is_json:
+                end_op |= PACK_JSON
+            if i == num_records - 1:
+                end_op |= PACK_END
+            record = PACK_RECORD.pack(end_op, mtime, len(key), len(value)) + key + value
+            chunks.append(PACK_CRC.pack(crc32(record) & 0xffffffff))
+            chunks.append(record)
+            offset += PACK_CRC.size + PACK_RECORD.size + len(key)
+            updates.append((op, key, offset, len(value), mtime, is_json))
+            offset += len(value)
+
+        try:
+            f = open(unicode(self.pack_path), 'ab')
+            try:
+                f.write(''.join(chunks))
+            finally:
+                f.close()
+        except IOError, e:
+            LOG.error('Failed writing userdata pack "%s": %s', self.pack_path, str(e))
+            # remove any partly written group so that later groups are not appended after it
+            try:
+                f = open(unicode(self.pack_path), 'r+b')
+                try:
+                    f.truncate(self.size)
+                finally:
+                    f.close()
+            except IOError:
+                pass
+            raise UserDataError
+
+        get_record_size = self._get_record_size
+        for (op, key, value_offset, value_length, mtime, is_json) in updates:
+            if key in index:
+                self.live_size -= get_record_size(key, index[key][1])
+            if op == PACK_SET:
+                index[key] = (value_offset, value_length, mtime, is_json)
+                self.live_size += get_record_size(key, value_length)
+            else:
+                index.pop(key, None)
+        self.size = offset
+
+        garbage_size = self.size - PACK_HEADER.size - self.live_size
+        if garbage_size > self.compact_size and garbage_size > self.live_size:
+            self._compact()
+
+
+    # must be called with the lock held
+    def _compact(self):
+        index = self.index
+        try:
+            values = self._read_values(index.keys())
+            self._write_pack([(key, value, index[key][2], index[key][3]) for (key, value) in values.iteritems()])
+        except (IOError, OSError), e:
+            # the pack is still complete so it can be compacted later
+            LOG.error('Failed compacting userdata pack "%s": %s', self.pack_path, str(e))
+
+
+    def get_keys(self):
+        with self.lock:
+            return self._read_index().keys()
+
+
+    def get_key_info(self):
+        with self.lock:
+            return dict((key, {'size': value_length, 'modified': mtime, 'json': is_json})
+                        for (key, (_, value_length, mtime, is_json)) in self._read_index().iteritems())
+
+
+    def exists(self, key):
+        with self.lock:
+            return key in self._read_index()
+
+
+    def get(self, key):
+        with self.lock:
+            if key not in self._read_index():
+                raise UserDataKeyError
+            try:
+                return self._read_values([key])[key]
+            except IOError, e:
+                LOG.error('Failed reading userdata pack "%s": %s', self.pack_path, str(e))
+                raise UserDataError
+
+
+    def get_many(self, keys):
+        with self.lock:
+            index = self._read_index()
+            try:
+                return self._read_values(set(key for key in keys if key in index))
+            except IOError, e:
+                LOG.error('Failed reading userdata pack "%s": %s', self.pack_path, str(e))
+                raise UserDataError
+
+
+    # the lock is released before the commit so that the groups appended while the pack is synced are
+    # committed together by the next sync
+    def set(self, key, value):
+        with self.lock:
+            self._append_records([(PACK_SET, str(key), _encode_value(value))])
+        self._commit()
+        return True
+
+
+    def set_many(self, key_values):
+        # the values are appended as one group so either all of them are kept or none of them are
+        records = [(PACK_SET, str(key), _encode_value(value)) for (key, value) in key_values.iteritems()]
+        if records:
+            with self.lock:
+                self._append_records(records)
+            self._commit()
+        return True
+
+
+    def remove(self, key):
+        with self.lock:
+            if key not in self._read_index():
+                raise UserDataKeyError
+            self._append_records([(PACK_REMOVE, str(key), '')])
+        self._commit()
+        return True
+
+
+    def remove_many(self, keys):
+        with self.lock:
+            index = self._read_index()
+            # check all of the keys exist before any are removed
+            for key in keys:
+                if key not in index:
+                    raise UserDataKeyError
+            if not keys:
+                return True
+            self._append_records([(PACK_REMOVE, str(key), '') for key in set(keys)])
+        self._commit()
+        return True
+
+
+    def remove_all(self):
+        with self.lock:
+            try:
+                self._write_pack([])
+            except (IOError, OSError), e:
+                LOG.error('Failed removing userdata: %s', str(e))
+                raise UserDataError
         return True
+
+
+class UserData(object):
+
+    validate_key = regex_compile('^[A-Za-z0-9]+([\-\.][A-Za-z0-9\-]+)*$')
+
+    # the store of each user's folder that has been used, shared by all of the UserData objects
+    stores = {}
+    stores_lock = Lock()
+
+    # the most recently read values keyed by (slug, username, key) up to a total size in bytes
+    value_cache = LRUCache(asint(config.get('userdata.cache_size', 16777216)), len)
+
+    # values of at least compress_size bytes are compressed when it makes them smaller
+    compress_size = asint(config.get('userdata.compress_size', 65536))
+    compress_level = asint(config.get('userdata.compress_level', 6))
+
+    def __init__(self, session=None, game=None, user=None):
+        if session is None:
+            self.game = game
+            self.user = user
+        else:
+            self.game = session.game
+            self.user = session.user
+
+        try:
+            path = config['userdata_db']
+        except KeyError:
+            LOG.error('userdata_db path config variable not set')
+            return
+
+        path = join_path(path, self.game.slug, self.user.username)
+        self.path = get_absolute_path(path)
+
+        with self.stores_lock:
+            try:
+                self.store = self.stores[self.path]
+            except KeyError:
+                # Create userdata folder and user folder on the game path
+                if not create_dir(path):
+                    raise UserDataPathError('User UserData path \"%s\" could not be created.' % path)
+
+                store_format = config.get('userdata.format', 'files')
+                if store_format == 'packed':
+                    store = UserDataPack(self.path)
+                else:
+                    if store_format != 'files':
+                        LOG.error('userdata.format must be one of %s', ', '.join(USERDATA_FORMATS))
+                    store = UserDataFiles(self.path)
+                self.store = self.stores[self.path] = store
+
+
+    @classmethod
+    def get_cache_stats(cls):
+        return cls.value_cache.get_stats()
+
+
+    def _get_cache_key(self, key):
+        return (self.game.slug, self.user.username, key)
+
+
+    def _encode(self, value):
+        value = _encode_value(value)
+        if 0 < self.compress_size <= len(value):
+            compressed_value = compress_value(value, self.compress_level)
+            if len(compressed_value) < len(value):
+                return compressed_value
+        return value
+
+
+    @classmethod
+    def _decode(cls, data):
+        if is_compressed(data):
+            return decompress_value(data)
+        return data
+
+
+    def get_keys(self):
+        return self.store.get_keys()
+
+
+    def get_key_info(self):
+        return self.store.get_key_info()
+
+
+    def exists(self, key):
+        return self.store.exists(key)
+
+
+    # returns the value as it is stored, use is_compressed to check if it is compressed
+    def get_stored(self, key):
+        value_cache = self.value_cache
+        cache_key = self._get_cache_key(key)
+        value = value_cache.get(cache_key)
+        if value is None:
+            # values read while the key is being changed are not cached
+            generation = value_cache.get_generation(cache_key)
+            value = self.store.get(key)
+            value_cache.set(cache_key, value, generation)
+        return value
+
+
+    def get(self, key):
+        return self._decode(self.get_stored(key))
+
+
+    def get_many(self, keys):
+        value_cache = self.value_cache
+        values = {}
+        missing_keys = []
+        for key in keys:
+            value = value_cache.get(self._get_cache_key(key))
+            if value is None:
+                missing_keys.append(key)
+            else:
+                values[key] = value
+
+        if missing_keys:
+            get_cache_key = self._get_cache_key
+            generations = dict((key, value_cache.get_generation(get_cache_key(key))) for key in missing_keys)
+            store_values = self.store.get_many(missing_keys)
+            for (key, value) in store_values.iteritems():
+                value_cache.set(get_cache_key(key), value, generations[key])
+            values.update(store_values)
+
+        decode = self._decode
+        return dict((key, decode(value)) for (key, value) in values.iteritems())
+
+
+    def _remove_cached(self, keys):
+        value_cache = self.value_cache
+        for key in keys:
+            value_cache.remove(self._get_cache_key(key))
+
+
+    # the cached values are removed after the store is changed so that any values read before the change
+    # are not cached by the reads that were running at the same time
+    def set(self, key, value):
+        try:
+            return self.store.set(key, self._encode(value))
+        finally:
+            self._remove_cached([key])
+
+
+    def set_many(self, key_values):
+        encode = self._encode
+        try:
+            return self.store.set_many(dict((key, encode(value)) for (key, value) in key_values.iteritems()))
+        finally:
+            self._remove_cached(key_values.keys())
+
+
+    def remove(self, key):
+        try:
+            return self.store.remove(key)
+        finally:
+            self._remove_cached([key])
+
+
+    def remove_many(self, keys):
+        try:
+            return self.store.remove_many(keys)
+        finally:
+            self._remove_cached(keys)
+
+
+    def remove_all(self):
+        keys = self.store.get_keys()
+        try:
+            return self.store.remove_all()
+        finally:
+            self._remove_cached(keys)
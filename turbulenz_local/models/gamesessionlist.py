@@ -1,23 +1,35 @@
 # Copyright (c) 2011-2014 Turbulenz Limited
 
 import logging
-from os.path import exists
-from turbulenz_local.tools import get_absolute_path
+from os import remove as remove_file
+from os.path import exists, splitext
+from turbulenz_local.tools import get_absolute_path, replace_file
 from turbulenz_local.models.userlist import get_user
 from turbulenz_local.models.gamelist import get_game_by_slug
 from turbulenz_local.lib.tools import create_id
 from turbulenz_local.lib.exceptions import InvalidGameSession
-from threading import Lock
+from threading import Lock, Thread
 from time import time
+from heapq import heappush, heappop, heapify
 
 # pylint: disable=F0401
 import yaml
 from pylons import config
+from paste.deploy.converters import asint
+from simplejson import dumps as json_dumps, loads as json_loads
 # pylint: enable=F0401
 
 LOG = logging.getLogger(__name__)
 
 
+def _remove_tmp(tmp_path):
+    if exists(tmp_path):
+        try:
+            remove_file(tmp_path)
+        except OSError:
+            pass
+
+
 class GameSession(object):
 
     def __init__(self, game, user, gamesession_id=None, created=None):
@@ -63,11 +75,24 @@ class GameSessionList(object):
     _reload = False     # Flag to be set if the list should be reloaded
 
     def __init__(self):
+        # only writers take the lock, get_session reads the sessions without it so writers must change them
+        # with single dict operations or by replacing the whole dict
         self.lock = Lock()
         self.lock.acquire()
         self._sessions = {}
         path = config.get('gamesessions.yaml', 'gamesessions.yaml')
         self.path = get_absolute_path(path)
+        # created and removed sessions are appended to the journal until it is compacted into the YAML file
+        self.journal_path = splitext(self.path)[0] + '.journal'
+        self.journal_size = 0
+        self.journal_compact_size = asint(config.get('gamesessions.journal_compact_size', 1048576))
+        self.compacting = False
+        # incremented when the YAML file is rewritten so that running compactions are discarded
+        self.generation = 0
+        # sessions are removed once they are older than the ttl, the heap holds the (created, id) of the sessions
+        # so the oldest is first and can contain sessions that have already been removed
+        self.ttl = asint(config.get('gamesessions.ttl', 86400))
+        self.expiry = []
         self.load_sessions()
         self.lock.release()
 
@@ -95,24 +120,55 @@ class GameSessionList(object):
     def purge_sessions(self):
         self.lock.acquire()
         self.load_sessions()
+        self._expire_sessions(write_journal=False)
+        self.write_sessions()
+        self.lock.release()
 
-        purge_time = time() - (1 * 86400)  # 1 day
-        delete_sessions = []
-        for string_id in self._sessions:
-            s = self._sessions[string_id]
-            if s.created < purge_time:
-                delete_sessions.append(string_id)
 
-        for s in delete_sessions:
-            del self._sessions[s]
+    # must be called with the lock held
+    def _build_expiry(self):
+        self.expiry = [(s.created, string_id) for (string_id, s) in self._sessions.iteritems()]
+        heapify(self.expiry)
 
-        self.write_sessions()
-        self.lock.release()
 
+    # must be called with the lock held
+    def _add_expiry(self, session):
+        expiry = self.expiry
+        heappush(expiry, (session.created, session.gamesession_id))
+        # drop the entries of removed sessions once they outnumber the sessions
+        if len(expiry) > 2 * len(self._sessions) + 64:
+            self._build_expiry()
 
+
+    # must be called with the lock held
+    def _expire_sessions(self, write_journal=True):
+        expiry = self.expiry
+        if not expiry:
+            return
+
+        expire_time = time() - self.ttl
+        if expiry[0][0] >= expire_time:
+            return
+
+        sessions = self._sessions
+        removed = []
+        while expiry and expiry[0][0] < expire_time:
+            (created, string_id) = heappop(expiry)
+            session = sessions.get(string_id)
+            if session is not None and session.created == created:
+                del sessions[string_id]
+                removed.append({'remove': string_id})
+
+        if removed and write_journal:
+            self._append_journal(removed)
+
+
+    # must be called with the lock held
     def load_sessions(self):
         path = self.path
-        self._sessions = {}
+        # the sessions are loaded into a new dict that replaces the current one so that sessions are never
+        # missing from lookups while they are loaded
+        sessions = {}
 
         if exists(path):
             f = open(path, 'r')
@@ -122,7 +178,7 @@ class GameSessionList(object):
                     for string_id in gamesessions:
                         file_gamesession = gamesessions[string_id]
                         try:
-                            self._sessions[string_id] = GameSession.from_dict(file_gamesession)
+                            sessions[string_id] = GameSession.from_dict(file_gamesession)
                         except InvalidGameSession:
                             pass
                 else:
@@ -132,9 +188,58 @@ class GameSessionList(object):
             finally:
                 f.close()
 
+        self._replay_journal(sessions)
+        self._sessions = sessions
+        self._build_expiry()
 
-    def write_sessions(self):
-        f = open(self.path, 'w')
+
+    def _replay_journal(self, sessions):
+        path = self.journal_path
+        self.journal_size = 0
+        if not exists(path):
+            return
+
+        try:
+            f = open(path, 'r')
+            try:
+                journal = f.read()
+            finally:
+                f.close()
+
+            # the last record can be incomplete if the server stopped while appending it, remove it so that
+            # the next record is not appended to it
+            end = journal.rfind('\n') + 1
+            if end < len(journal):
+                LOG.warning('Ignoring incomplete record at the end of gamesessions journal "%s"', path)
+                f = open(path, 'r+')
+                try:
+                    f.truncate(end)
+                finally:
+                    f.close()
+        except IOError as e:
+            LOG.error('Failed loading gamesessions journal "%s": %s', path, str(e))
+            return
+
+        for record in journal[:end].splitlines():
+            try:
+                record = json_loads(record)
+                if 'create' in record:
+                    file_gamesession = record['create']
+                    string_id = file_gamesession['gameSessionId']
+                    try:
+                        sessions[string_id] = GameSession.from_dict(file_gamesession)
+                    except InvalidGameSession:
+                        sessions.pop(string_id, None)
+                else:
+                    sessions.pop(record['remove'], None)
+            except (ValueError, KeyError, TypeError):
+                LOG.warning('Ignoring invalid record in gamesessions journal "%s"', path)
+
+        self.journal_size = end
+
+
+    # must be called with the lock held
+    def _get_file_sessions(self):
         file_sessions = {}
         ghost_sessions = set()
         for string_id in self._sessions:
@@ -148,19 +253,117 @@ class GameSessionList(object):
         for g in ghost_sessions:
             del self._sessions[g]
 
+        return file_sessions
+
+
+    def _write_sessions_file(self, path, file_sessions):
+        f = open(path, 'w')
         try:
             yaml.dump(file_sessions, f)
         finally:
             f.close()
 
 
+    # must be called with the lock held
+    def write_sessions(self):
+        """ Rewrites the YAML file with every session and empties the journal """
+        self.generation += 1
+        tmp_path = self.path + '.tmp'
+        try:
+            self._write_sessions_file(tmp_path, self._get_file_sessions())
+            replace_file(tmp_path, self.path)
+            if exists(self.journal_path):
+                remove_file(self.journal_path)
+            self.journal_size = 0
+        except (IOError, OSError) as e:
+            LOG.error('Failed writing gamesessions file "%s": %s', self.path, str(e))
+            _remove_tmp(tmp_path)
+
+
+    # must be called with the lock held
+    def _append_journal(self, records):
+        records = ''.join([json_dumps(r, separators=(',', ':')) + '\n' for r in records])
+        try:
+            f = open(self.journal_path, 'a')
+            try:
+                f.write(records)
+            finally:
+                f.close()
+        except IOError as e:
+            LOG.error('Failed writing gamesessions journal "%s": %s', self.journal_path, str(e))
+            return
+
+        self.journal_size += len(records)
+        if self.journal_size > self.journal_compact_size and not self.compacting:
+            self._start_compaction()
+
+
+    # must be called with the lock held
+    def _start_compaction(self):
+        self.compacting = True
+        thread = Thread(target=self._compact_journal,
+                        args=[self._get_file_sessions(), self.journal_size, self.generation])
+        thread.daemon = True
+        thread.start()
+
+
+    def _compact_journal(self, file_sessions, journal_offset, generation):
+        # runs in its own thread so any error must be logged here and compacting always reset
+        tmp_path = self.path + '.tmp'
+        try:
+            self._write_sessions_file(tmp_path, file_sessions)
+            with self.lock:
+                # the sessions are discarded if they were all written while the snapshot was being written
+                if generation == self.generation:
+                    self._replace_snapshot(tmp_path, journal_offset)
+        # pylint: disable=W0703
+        except Exception as e:
+            LOG.exception('Failed compacting gamesessions journal "%s": %s', self.journal_path, str(e))
+        # pylint: enable=W0703
+        finally:
+            with self.lock:
+                self.compacting = False
+            # left behind if the snapshot failed or was discarded
+            _remove_tmp(tmp_path)
+
+
+    # must be called with the lock held
+    def _replace_snapshot(self, tmp_path, journal_offset):
+        journal_tmp_path = self.journal_path + '.tmp'
+        try:
+            replace_file(tmp_path, self.path)
+
+            # keep only the records appended while the snapshot was being written
+            f = open(self.journal_path, 'r')
+            try:
+                f.seek(journal_offset)
+                records = f.read()
+            finally:
+                f.close()
+
+            f = open(journal_tmp_path, 'w')
+            try:
+                f.write(records)
+            finally:
+                f.close()
+            replace_file(journal_tmp_path, self.journal_path)
+            self.journal_size = len(records)
+
+        except (IOError, OSError) as e:
+            # the journal is replayed over the snapshot so it is still consistent
+            LOG.error('Failed compacting gamesessions journal "%s": %s', self.journal_path, str(e))
+            _remove_tmp(journal_tmp_path)
+
+
     def create_session(self, user, game):
         if user is None or game is None:
             return None
         session = GameSession(game, user)
         with self.lock:
+            self._expire_sessions()
             self._sessions[session.gamesession_id] = session
-            self.write_sessions()
+            self._add_expiry(session)
+            self._append_journal([{'create': session.to_dict()}])
             return session
 
 
@@ -169,7 +372,7 @@ class GameSessionList(object):
             sessions = self._sessions
             if string_id in sessions:
                 del sessions[string_id]
-                self.write_sessions()
+                self._append_journal([{'remove': string_id}])
                 return True
             else:
                 return False
@@ -180,23 +383,33 @@ class GameSessionList(object):
 
         with self.lock:
             sessions = self._sessions
+            removed = []
             for s in sessions.values():
                 if s.game.slug == slug and \
                    s.user.username == username:
 
                     del sessions[s.gamesession_id]
+                    removed.append({'remove': s.gamesession_id})
 
-            self.write_sessions()
+            if removed:
+                self._append_journal(removed)
 
 
     def get_session(self, string_id):
-        with self.lock:
-            session = self._sessions.get(string_id, None)
-            return session
+        session = self._sessions.get(string_id, None)
+        if session is not None and session.created < time() - self.ttl:
+            # expire the sessions now unless a writer is already holding the lock
+            if self.lock.acquire(False):
+                try:
+                    self._expire_sessions()
+                finally:
+                    self.lock.release()
+            return None
+        return session
 
 
     def update_session(self, session):
         with self.lock:
             self._sessions[session.gamesession_id] = session
-            self.write_sessions()
-            self.lock.release()
+            self._add_expiry(session)
+            self._append_journal([{'create': session.to_dict()}])
@@ -32,12 +32,18 @@ class UserList(object):
 
     def __init__(self):
         self.users = {}
+        # prebuilt public user details keyed by lowercase username that can be read without the lock
+        self.user_summaries = {}
         self.lock = Lock()
         self._read_users()
 
+    def _set_user(self, username, user):
+        self.users[username] = user
+        self.user_summaries.pop(username.lower(), None)
+
     def _add_user(self, user_info):
         user = User(user_info)
-        self.users[user.username] = user
+        self._set_user(user.username, user)
         return user
 
     def to_dict(self):
@@ -97,7 +103,7 @@ class UserList(object):
                     if u['username'].lower() not in self.users:
                         user = User(u, default=True)
                         username = user.username.lower()
-                        self.users[username] = user
+                        self._set_user(username, user)
                         do_save = True
             finally:
                 f.close()
@@ -125,6 +131,28 @@ class UserList(object):
                 except ValueError as e:
                     raise BadRequest(str(e))
 
+    def get_user_summary(self, username):
+        username_lower = username.lower()
+        try:
+            summary = self.user_summaries[username_lower]
+            # the summary shows the username as it was given
+            if summary['username'] == username:
+                return summary
+        except KeyError:
+            pass
+
+        user = self.get_user(username)
+        summary = {
+            'username': username,
+            'displayName': username,
+            'avatar': user.avatar
+        }
+        with self.lock:
+            # do not cache the summary if the user was replaced while it was being built
+            if self.users.get(user.username) is user:
+                self.user_summaries[username_lower] = summary
+        return summary
+
     def get_current_user(self):
         username = request.cookies.get('local')
         if username:
@@ -152,6 +180,10 @@ def get_user(username):
     return UserList.get_instance().get_user(username)
 
 
+def get_user_summary(username):
+    return UserList.get_instance().get_user_summary(username)
+
+
 def get_current_user():
     return UserList.get_instance().get_current_user()
 
@@ -16,6 +16,8 @@ from paste.deploy.converters import asbool
 from turbulenz_local.lib.multiplayer import MultiplayerHandler, MultiplayerStatusHandler, SessionStatusHandler
 from turbulenz_local.lib.responsefromfile import ResponseFromFileHandler
 from turbulenz_local.handlers.localv1.save import SaveFileHandler
+from turbulenz_local.handlers.apiv1.datashare import DataShareWatchHandler
+from turbulenz_local.handlers.apiv1.gamenotifications import GameNotificationsPollHandler
 
 # pylint: disable=R0904
 class DevserverWSGIContainer(WSGIContainer):
@@ -102,6 +104,8 @@ def run(wsgi_app, global_conf,
                          ResponseFromFileHandler, dict(path=raw_response_dir)))
 
     handlers.append(('/local/v1/save/([^/]+)/(.*)', SaveFileHandler))
+    handlers.append(('/api/v1/data-share/watch/([A-Za-z0-9]+)', DataShareWatchHandler))
+    handlers.append(('/api/v1/game-notifications/long-poll/([A-Za-z0-9\-]+)', GameNotificationsPollHandler))
 
     handlers.append(('.*', FallbackHandler, dict(fallback=wsgi_app)))
 
@@ -60,6 +60,9 @@ def make_map():
         m.connect('userdata-keys', '/{username}', action='userkeys')
         m.connect('userdata-as-text', '/{username}/{key:[A-Za-z0-9]+([\-\.][A-Za-z0-9\-]+)*}', action='as_text')
 
+    with router.submapper(controller="localv1/userdata", path_prefix='/local/v1/userdata-cache') as m:
+        m.connect('userdata-cache-stats', '/stats', action='cache_stats')
+
     with router.submapper(controller="localv1/deploy", path_prefix='/local/v1/deploy') as m:
         m.connect('deploy-login', '/login', action='login')
         m.connect('deploy-try-login', '/try-login', action='try_login')
@@ -80,6 +83,10 @@ def make_map():
         m.connect('/remove-all', action='remove_all')
         m.connect('/read', action='read_keys')
 
+        m.connect('/read-batch', action='read_batch')
+        m.connect('/set-batch', action='set_batch')
+        m.connect('/remove-batch', action='remove_batch')
+
         # for backwards compatibility
         m.connect('/get/{key:[A-Za-z0-9]+([\-\.][A-Za-z0-9\-]+)*}', action='read')
         m.connect('/get-keys', action='read_keys')
@@ -102,6 +109,7 @@ def make_map():
 
         # Leaderboards Developer API
         m.connect('/scores/set/{key:[A-Za-z0-9]+([\-\.][A-Za-z0-9]+)*}', action='set')
+        m.connect('/scores/set-batch', action='set_batch')
 
         # Local API for testing only
         m.connect('/scores/remove-all/{slug:[A-Za-z0-9\-]+}', action='remove_all')
@@ -132,6 +140,7 @@ def make_map():
         # Secure API (requires gameSessionId)
         m.connect('/read/{datashare_id:[A-Za-z0-9]+}', action='read')
         m.connect('/read/{datashare_id:[A-Za-z0-9]+}/{key:[A-Za-z0-9]+([\-\.][A-Za-z0-9]+)*}', action='read_key')
+        m.connect('/read-batch/{datashare_id:[A-Za-z0-9]+}', action='read_batch')
         m.connect('/set/{datashare_id:[A-Za-z0-9]+}/{key:[A-Za-z0-9]+([\-\.][A-Za-z0-9]+)*}', action='set_key')
         m.connect('/compare-and-set/{datashare_id:[A-Za-z0-9]+}/{key:[A-Za-z0-9]+([\-\.][A-Za-z0-9]+)*}',
                   action='compare_and_set_key')
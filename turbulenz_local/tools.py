@@ -71,6 +71,33 @@ def create_dir(directory):
                 return False
         return os.access(absDir, os.W_OK)
 
+def replace_file(src_path, dst_path):
+    """
+    Rename src_path over dst_path, removing dst_path first on platforms where
+    rename will not replace an existing file.
+    """
+    try:
+        os.rename(src_path, dst_path)
+    except OSError:
+        if not exists(dst_path):
+            raise
+        os.remove(dst_path)
+        os.rename(src_path, dst_path)
+
+def sync_dir(directory):
+    """
+    Flush the directory entries to disk so that files created, renamed or
+    removed in it are kept after a power loss. Windows cannot open
+    directories so this does nothing there.
+    """
+    if SYSNAME == 'Windows':
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 def load_json_asset(json_path):
     # Load mapping table
     try:
@@ -168,6 +195,25 @@ def get_7zip_path():
     else:
         return None
 
+def accepts_gzip(environ):
+    """
+    Return 'True' if the Accept-Encoding header of the request accepts gzip,
+    an encoding given a q-value of 0 is refused.
+    """
+    qualities = {}
+    for coding in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        params = coding.split(';')
+        quality = 1.0
+        for param in params[1:]:
+            (name, _, value) = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[params[0].strip().lower()] = quality
+    return qualities.get('gzip', qualities.get('*', 0.0)) > 0
+
 def get_remote_addr(request, keep_forwarding_chain=False):
     forward_chain = request.headers.get('X-Forwarded-For')
     if forward_chain: